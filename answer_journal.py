@@ -0,0 +1,91 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+# 作答紀錄：以 JSON Lines 格式附加寫入檔案。
+# 請求只把紀錄放進佇列，由背景執行緒批次寫入，定時或結束時 fsync。
+
+_STOP = object()
+
+
+class AnswerJournal:
+    def __init__(self, path, fsync_interval=1.0, batch_size=256):
+        self.path = str(path)
+        self.fsync_interval = fsync_interval
+        self.batch_size = batch_size
+        # 在建構時開啟檔案，路徑無法寫入時於啟動階段就拋出 OSError
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._error = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name="answer-journal", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, **fields):
+        """加入一筆紀錄（不等待寫入）；會自動加上時間戳記 ts。
+
+        寫入失敗後背景執行緒已停止，之後的紀錄直接捨棄，不再堆積在佇列中。
+        """
+        if self._error is not None:
+            return
+        fields.setdefault("ts", time.time())
+        self._queue.put(fields)
+
+    def close(self):
+        """寫入剩餘紀錄並 fsync 後結束背景執行緒。"""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        try:
+            self._write_loop(self._file)
+        except OSError as e:
+            self._error = e
+            print(f"❌ 作答紀錄寫入 {self.path} 失敗，停止記錄：{e}")
+        finally:
+            try:
+                self._file.close()
+            except OSError:
+                # 寫入失敗時緩衝區仍有資料，關閉檔案會再次失敗；錯誤已在上面回報
+                pass
+
+    def _write_loop(self, f):
+        last_sync = time.monotonic()
+        unsynced = False
+        stopping = False
+        while not stopping:
+            try:
+                item = self._queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                # 一段時間沒有新紀錄時，補做先前延後的 fsync
+                if unsynced:
+                    os.fsync(f.fileno())
+                    last_sync = time.monotonic()
+                    unsynced = False
+                continue
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if _STOP in batch:
+                stopping = True
+                batch = [record for record in batch if record is not _STOP]
+            f.writelines(
+                json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+                + "\n"
+                for record in batch
+            )
+            f.flush()
+            unsynced = True
+            if stopping or time.monotonic() - last_sync >= self.fsync_interval:
+                os.fsync(f.fileno())
+                last_sync = time.monotonic()
+                unsynced = False
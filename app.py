@@ -1,15 +1,76 @@
 from flask import Flask, render_template, request, jsonify, Response, redirect, url_for, session
+import bisect
+import hashlib
 import json
 import random
+import threading
+from collections import namedtuple
+from functools import lru_cache
 from pathlib import Path
 from google import genai
 import os
 
+import question_bank
+from client_pool import ClientPool
+from explanation_cache import ExplanationCache, prompt_hash
+from gemini_async import AsyncGeminiRunner
+from rate_limiter import RateLimiter, RateLimitTimeout
+from quiz_state import QuizState
+from session_store import SqliteSessionInterface
+
 app = Flask(__name__)
 
 APP_PASSWORD = os.environ.get("APP_PASSWORD")
 app.secret_key = os.environ.get("APP_SECRET_KEY")
 MODEL = "gemini-2.5-flash"
+# 平行解析題庫的行程數；預設 1 表示依序載入
+LOAD_WORKERS = int(os.environ.get("QBANK_LOAD_WORKERS", "1"))
+# 設定 QBANK_PRELOAD=1 時（gunicorn.conf.py 預設開啟），題庫在 gunicorn master 載入一次，
+# worker 以 fork 共用記憶體；不能跨 fork 共用的資源則在 worker 啟動後由 init_worker 建立
+PRELOAD = os.environ.get("QBANK_PRELOAD") == "1"
+ai_runner = None
+explanation_cache = None
+client_pool = None
+
+def init_worker():
+    """建立每個行程各自擁有的資源：SQLite 連線與 Gemini event loop 執行緒。"""
+    global ai_runner, explanation_cache, client_pool
+    # 設定 QBANK_ASYNC_AI=1 時，Gemini 串流改用 client.aio 並共用一個 event loop；
+    # WSGI 執行緒仍會等待串流結束，並不增加 app.py 可同時處理的請求數（見 gunicorn.conf.py 的 threads）
+    ai_runner = AsyncGeminiRunner() if os.environ.get("QBANK_ASYNC_AI") == "1" else None
+    # session 內容存在伺服器端的 SQLite，cookie 只保存 session id
+    app.session_interface = SqliteSessionInterface(os.environ.get("QBANK_SESSION_DB", "qbank_sessions.sqlite3"))
+    # AI 詳解存在 SQLite 快取，session 只記錄 {題號: prompt 雜湊} 作為參照
+    explanation_cache = ExplanationCache(os.environ.get("QBANK_AI_CACHE", "ai_explanation_cache.sqlite3"))
+    # Gemini client 依 API Key 重複使用，保留 HTTP 連線
+    client_pool = ClientPool(
+        genai.Client,
+        max_clients=int(os.environ.get("QBANK_CLIENT_POOL_SIZE", "64")),
+        idle_seconds=int(os.environ.get("QBANK_CLIENT_IDLE_SECONDS", "600")),
+    )
+
+# Gemini 配額以 API Key 計算，每把 API Key 各有一個限流器；
+# QBANK_AI_RPM / QBANK_AI_TPM 為每分鐘請求數與 token 數上限（未設定則不限制，僅在配額錯誤時重試）
+AI_RPM = int(os.environ["QBANK_AI_RPM"]) if os.environ.get("QBANK_AI_RPM") else None
+AI_TPM = int(os.environ["QBANK_AI_TPM"]) if os.environ.get("QBANK_AI_TPM") else None
+AI_MAX_WAIT = float(os.environ.get("QBANK_AI_MAX_WAIT", "30"))
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def rate_limiter_for(api_key):
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(api_key)
+        if limiter is None:
+            limiter = rate_limiters[api_key] = RateLimiter(
+                rpm=AI_RPM, tpm=AI_TPM, max_wait=AI_MAX_WAIT
+            )
+        return limiter
+
+# 瀏覽器在串流途中離線時的處理方式：finish 在背景完成生成並寫入快取；cancel 立即停止上游請求
+AI_DISCONNECT = os.environ.get("QBANK_AI_DISCONNECT", "finish")
+
+# 隨機模式與錯題模式的洗牌亂數來源
+random_rng = random.Random()
 
 # --- 登入頁 ---
 @app.route("/login", methods=["GET", "POST"])
@@ -23,6 +84,8 @@ def login():
         if not api_key:
             return render_template("login.html", error="請輸入 Gemini API Key")
 
+        # 登入成功後換發新的 session id，避免 session fixation
+        app.session_interface.regenerate(session)
         # 記錄 session
         session["logged_in"] = True
         session["gemini_api_key"] = api_key
@@ -45,24 +108,13 @@ def select():
         if not selected_stems:
             return render_template("select.html", files=available_jsons, error="請至少選擇一個題庫")
 
-        # 將選擇的題庫 ID 儲存在 session 中
+        # 將選擇的題庫 ID 儲存在 session 中；題號清單由全域索引提供，不存入 session
         session["selected_question_sets"] = selected_stems
-        session.pop("current_question_ids", None)
-        
-        # 載入選定的題目 IDs，並將狀態儲存到 Session
-        all_questions_for_user = []
-        for stem in selected_stems:
-            questions_list = ALL_QUESTIONS_DATA.get(stem, [])
-            all_questions_for_user.extend(questions_list)
-        
-        session["current_question_ids"] = [q["題號"] for q in all_questions_for_user]
-        
-        # 初始化 Session 狀態
-        session["wrong_questions"] = []
-        session["marked_questions"] = []
-        session["answered_questions"] = []
-        session["remaining_question_ids"] = session["current_question_ids"].copy()
-        session["question_index"] = 0
+        selection = get_selection(tuple(selected_stems))
+
+        # 初始化 Session 狀態：已答題目、錯題與出題順序都以題目在選定題庫中的位置記錄
+        session["quiz_state"] = QuizState(len(selection.ids))
+        session["quiz_selection"] = selection.digest
         session["total_tokens_used"] = 0
 
         return redirect(url_for("index"))
@@ -74,57 +126,58 @@ def index():
     if not session.get("logged_in"):
         return redirect(url_for("login"))
     
-    # 從 session 取得當前題號列表
-    current_question_ids = session.get("current_question_ids")
+    # 從全域索引取得當前題號列表
+    selection = current_selection()
     
-    if not current_question_ids:
+    if not selection:
         return redirect(url_for("select"))
 
     # 傳遞所有題號給前端，以便生成下拉選單
-    # 注意：這裡使用 current_question_ids
-    return render_template("index.html", all_question_ids=current_question_ids, total_questions=len(current_question_ids))
+    return render_template("index.html", all_question_ids=selection.ids, total_questions=len(selection.ids))
 
 @app.route("/test")
 def test():
-    # 從 session 取得當前題號列表
-    current_question_ids = session.get("current_question_ids")
-    if not current_question_ids:
+    # 從全域索引取得當前題號列表
+    selection = current_selection()
+    if not selection:
          return redirect(url_for("select")) # 如果沒有題庫，導向選擇頁
 
     # 傳遞所有題號給前端，以便生成下拉選單
-    return render_template("index_test.html", all_question_ids=current_question_ids, total_questions=len(current_question_ids))
+    return render_template("index_test.html", all_question_ids=selection.ids, total_questions=len(selection.ids))
 
 @app.route("/review")
 def review():
-    wrong_questions = session.get("wrong_questions", [])
+    state = session.get("quiz_state")
+    wrong_questions = questions_by_ids(current_selection(), state.wrong if state else [])
     return render_template("review.html", wrong_questions=wrong_questions)
 
 @app.route("/review_marked")
 def review_marked():
-    marked_questions = session.get("marked_questions", [])
+    state = session.get("quiz_state")
+    marked_questions = questions_by_ids(current_selection(), state.marked if state else [])
     return render_template("review_marked.html", marked_questions=marked_questions)
 
 @app.route("/review_ai")
 def review_ai():
     q_ai = []
-    # 從 session 取得 AI 詳解快取
-    ai_explanation_cache = session.get("ai_explanation_cache", {})
+    # 依 session 中的參照，從詳解快取取得 AI 詳解
+    ai_explanations = explanation_cache.get_many_by_hash(session.get("ai_explanation_refs", {}))
     
-    # 取得當前已選擇的題庫 ID 列表
-    current_question_ids = session.get("current_question_ids", [])
-    
-    # 建立一個從題號到題目物件的映射，以便快速查詢
-    q_id_to_question_map = {q["題號"]: q for q_list in ALL_QUESTIONS_DATA.values() for q in q_list}
-
-    for q_id in current_question_ids:
-        explanation = ai_explanation_cache.get(q_id, "")
-        if explanation:
-            # 從 ALL_QUESTIONS_DATA 中取得完整的題目資訊
-            q = q_id_to_question_map.get(q_id)
-            if q:
-                q_copy = q.copy()
-                q_copy["ai_explanation"] = explanation
-                q_ai.append(q_copy)
+    selection = current_selection()
+    if selection is None:
+        return render_template("review_ai.html", q_ai=q_ai)
+
+    # 只保留當前選定題庫中的題目，並依題目位置排序
+    positions = {}
+    for q_id in ai_explanations:
+        position = position_of(selection, q_id)
+        if position is not None:
+            positions[q_id] = position
+
+    for q_id in sorted(positions, key=positions.get):
+        q_copy = question_at(selection, positions[q_id]).copy()
+        q_copy["ai_explanation"] = ai_explanations[q_id]
+        q_ai.append(q_copy)
                 
     return render_template("review_ai.html", q_ai=q_ai)
 
@@ -133,49 +186,42 @@ def get_question():
     mode = request.args.get("mode", "random")
     question_id = request.args.get("question_id")
 
-    current_question_ids = session.get("current_question_ids")
-    if not current_question_ids:
+    selection = current_selection()
+    state = current_quiz_state(selection)
+    if not selection or state is None:
         return jsonify({"error": "題庫尚未載入"})
 
-    q_id_to_question_map = {q["題號"]: q for q_list in ALL_QUESTIONS_DATA.values() for q in q_list}
-
     q = None
     if question_id:
-        q = q_id_to_question_map.get(question_id)
-        if q:
-            try:
-                session["question_index"] = current_question_ids.index(question_id)
-            except ValueError:
-                pass
-        else:
+        position = position_of(selection, question_id)
+        if position is None:
             return jsonify({"error": f"找不到題號為 {question_id} 的題目"})
+        q = question_at(selection, position)
+        state.question_index = position
     elif mode == "wrong":
-        wrong_questions_list = session.get("wrong_questions", [])
-        if wrong_questions_list:
-            q = random.choice(wrong_questions_list)
+        if state.wrong:
+            q = question_by_id(selection, state.next_wrong(random_rng))
         else:
             return jsonify({"error": "目前沒有錯題"})
     elif mode == "random":
-        remaining_ids = session.get("remaining_question_ids", [])
-        if remaining_ids:
-            q_id = random.choice(remaining_ids)
-            q = q_id_to_question_map.get(q_id)
+        position = state.draw_random_index(random_rng)
+        if position is not None:
+            q = question_at(selection, position)
     else:  # order
-        q_index = session.get("question_index", 0)
-        if q_index < len(current_question_ids):
-            q_id = current_question_ids[q_index]
-            q = q_id_to_question_map.get(q_id)
-            session["question_index"] = q_index + 1
+        if state.question_index < len(selection.ids):
+            q = question_at(selection, state.question_index)
+            state.question_index += 1
         else:
             # 所有題目已出完
             return jsonify({"error": "所有題目都已出完！", "finished": True})
+    # 狀態物件直接被修改，需告知 session 寫回
+    session.modified = True
 
     if q is None:
         return jsonify({"error": "所有題目都已出完！", "finished": True})
 
     question_copy = q.copy()
-    marked_ids = [mq["題號"] for mq in session.get("marked_questions", [])]
-    question_copy["is_marked"] = question_copy.get("題號") in marked_ids
+    question_copy["is_marked"] = question_copy.get("題號") in state.marked
     question_copy["is_multiple"] = True if question_copy.get("題別") == "複" else False
     return jsonify(question_copy)
 
@@ -188,27 +234,22 @@ def submit_answer():
     correct = q.get("答案", "").strip().upper()
     is_correct = (answer == correct)
 
-    wrong_questions_list = session.get("wrong_questions", [])
-    if not is_correct:
-        if q not in wrong_questions_list:
-            wrong_questions_list.append(q)
-            session["wrong_questions"] = wrong_questions_list
-    
-    answered_ids = session.get("answered_questions", [])
-    answered_ids.append(q.get("題號"))
-    session["answered_questions"] = answered_ids
-    
-    remaining_ids = session.get("remaining_question_ids", [])
-    if q.get("題號") in remaining_ids:
-        remaining_ids.remove(q.get("題號"))
-        session["remaining_question_ids"] = remaining_ids
-        
-    all_q_ids = session.get("current_question_ids", [])
+    selection = current_selection()
+    state = current_quiz_state(selection)
+    if not selection or state is None:
+        return jsonify({"error": "題庫尚未載入"})
+
+    position = position_of(selection, q.get("題號"))
+    if position is not None:
+        if not is_correct:
+            state.add_wrong(q.get("題號"))
+        state.mark_answered(position)
+        session.modified = True
     
     return jsonify({
         "correct": is_correct,
         "right_answer": correct,
-        "answered_count": f"{len(answered_ids)}/{len(all_q_ids)}"
+        "answered_count": f"{state.answered_count}/{len(selection.ids)}"
     })
 
 @app.route("/mark_question", methods=["POST"])
@@ -216,25 +257,110 @@ def mark_question():
     data = request.json
     q = data["question"]
     
-    # 從 session 取得標記題目列表
-    marked_questions = session.get("marked_questions", [])
+    selection = current_selection()
+    state = current_quiz_state(selection)
     
     # 儲存題號，而不是整個題目物件
-    if q.get("題號") not in [mq.get("題號") for mq in marked_questions]:
-        marked_questions.append(q)
-        # 將修改後的列表存回 session
-        session["marked_questions"] = marked_questions
+    if selection and state is not None and position_of(selection, q.get("題號")) is not None:
+        if q.get("題號") not in state.marked:
+            state.toggle_marked(q.get("題號"))
+            session.modified = True
         
     return jsonify({"status": "marked"})
 
 @app.route("/reset_questions", methods=["POST"])
 def reset_questions():
-    all_q_ids = session.get("current_question_ids", [])
-    session["remaining_question_ids"] = all_q_ids.copy()
-    session["question_index"] = 0
-    session["answered_questions"] = []
+    state = current_quiz_state(current_selection())
+    if state is not None:
+        state.reset()
+        session.modified = True
     return jsonify({"status": "reset"})
 
+def build_prompt(question, is_detail):
+    if is_detail:
+        return f"請以繁體中文，針對以下問題提供詳細的解釋：\n\n題目：{question['題目']}\n選項：{' '.join(question['選項'])}\n答案：{question['答案']}"
+    return f"請以繁體中文，針對以下問題，生成 1 分鐘內可以閱讀完的詳解，包含關鍵概念和每個選項解釋，文字簡明，重點清楚：\n\n題目：{question['題目']}\n選項：{' '.join(question['選項'])}\n答案：{question['答案']}"
+
+def resolve_question(question):
+    """優先使用伺服器端的題目內容，讓所有使用者對同一題產生相同的 prompt。"""
+    selection = current_selection()
+    if selection is not None:
+        return question_by_id(selection, question["題號"]) or question
+    return question
+
+def shared_explanation(question_id, prompt):
+    """從所有使用者共用的詳解快取取得詳解；命中時記入本使用者的參照與命中次數。"""
+    explanation = explanation_cache.get(question_id, prompt)
+    if explanation is not None:
+        link_explanation(question_id, prompt)
+        session["ai_cache_hits"] = session.get("ai_cache_hits", 0) + 1
+    return explanation
+
+def link_explanation(question_id, prompt, data=None):
+    """session 只記錄 prompt 雜湊，供詳解總覽頁查詢。"""
+    data = session if data is None else data
+    refs = data.get("ai_explanation_refs", {})
+    refs[question_id] = prompt_hash(prompt)
+    data["ai_explanation_refs"] = refs
+
+def remember_explanation(question_id, prompt, explanation, tokens):
+    """將詳解存入共用快取，並記錄本使用者的參照。"""
+    explanation_cache.put(question_id, prompt, explanation, tokens)
+    link_explanation(question_id, prompt)
+
+def record_stream(sid, question_id, prompt, explanation, tokens):
+    """串流結束（或中斷）後累計 token；explanation 為完整詳解時才寫入快取。
+
+    回應已開始傳送，session 改以 session_interface.update 直接更新伺服器端的資料，
+    回傳更新後的累積 token 數。
+    """
+    if explanation:
+        explanation_cache.put(question_id, prompt, explanation, tokens)
+
+    def modify(data):
+        data["total_tokens_used"] = data.get("total_tokens_used", 0) + tokens
+        if explanation:
+            link_explanation(question_id, prompt, data)
+
+    return app.session_interface.update(app, sid, modify)["total_tokens_used"]
+
+def close_stream(response):
+    close = getattr(response, "close", None)
+    if close is not None:
+        close()
+
+def drain_stream(response, sid, question_id, prompt, explanation, tokens):
+    """瀏覽器離線後在背景讀完上游串流，完成時寫入快取並記錄 token。"""
+    try:
+        for chunk in response:
+            if chunk.text:
+                explanation += chunk.text
+            if chunk.usage_metadata:
+                tokens = chunk.usage_metadata.total_token_count or 0
+    except Exception as e:
+        print(f"Gemini API 呼叫失敗: {e}")
+        close_stream(response)
+        explanation = None
+    record_stream(sid, question_id, prompt, explanation, tokens)
+
+@app.route("/ai_rate_stats")
+def ai_rate_stats():
+    api_key = session.get("gemini_api_key")
+    if not session.get("logged_in") or not api_key:
+        return jsonify({"error": "未登入"}), 403
+    # 只回傳目前使用者 API Key 的限流狀態
+    return jsonify(rate_limiter_for(api_key).metrics())
+
+@app.route("/ai_cache_stats")
+def ai_cache_stats():
+    stats = explanation_cache.stats()
+    # token 用量依使用者分開計算；共用快取命中不消耗 token
+    stats["user"] = {
+        "total_tokens_used": session.get("total_tokens_used", 0),
+        "cache_hits": session.get("ai_cache_hits", 0),
+    }
+    return jsonify(stats)
+
 @app.route("/get_ai_explanation", methods=["POST"])
 def get_ai_explanation():
     total_tokens_used = session.get("total_tokens_used", 0)
@@ -247,21 +373,21 @@ def get_ai_explanation():
     if not api_key:
         return jsonify({"error": "缺少 API Key"}), 403
 
-    client = genai.Client(api_key=api_key)
+    # 同一把 API Key 沿用既有的 client 與連線，並共用同一個限流器
+    client = client_pool.get(api_key)
+    limiter = rate_limiter_for(api_key)
 
     # 取得題目
     is_detail = request.args.get("detail", "false").lower() == "true"
     data = request.json
-    question = data.get("question")
+    question = resolve_question(data.get("question"))
     question_id = question["題號"]
+    prompt = build_prompt(question, is_detail)
     
-    # 從 session 取得 AI 詳解快取
-    ai_explanation_cache = session.get("ai_explanation_cache", {})
-    
-    # 步驟 1: 檢查 session 快取中是否有詳解
-    if question_id in ai_explanation_cache:
-        print(f"✅ 題號 {question_id} 的詳解已從 Session 快取中取得。")
-        explanation = ai_explanation_cache[question_id]
+    # 步驟 1: 檢查所有使用者共用的詳解快取（題號 + prompt）
+    explanation = shared_explanation(question_id, prompt)
+    if explanation is not None:
+        print(f"✅ 題號 {question_id} 的詳解已從快取中取得。")
         return jsonify({
             "explanation": explanation,
             "current_tokens": 0,
@@ -269,25 +395,23 @@ def get_ai_explanation():
         })
 
     # 步驟 2: 如果快取中沒有，則執行 API 呼叫
-    prompt = f"請以繁體中文，針對以下問題，生成 1 分鐘內可以閱讀完的詳解，包含關鍵概念和每個選項解釋，文字簡明，重點清楚：\n\n題目：{question['題目']}\n選項：{' '.join(question['選項'])}\n答案：{question['答案']}"
-    if is_detail:
-        prompt = f"請以繁體中文，針對以下問題提供詳細的解釋：\n\n題目：{question['題目']}\n選項：{' '.join(question['選項'])}\n答案：{question['答案']}"
-        
     try:
         # response = model.generate_content(prompt)
-        response = client.models.generate_content(
-            model=MODEL,
-            contents=prompt,
+        response = limiter.call(
+            lambda: client.models.generate_content(
+                model=MODEL,
+                contents=prompt,
+            ),
+            session.sid,
         )
         # 移除這行程式碼，讓 AI 回傳的換行和格式得以保留
         explanation = response.text
 
-        # 步驟 3: 將新的詳解儲存到 session 快取中
-        ai_explanation_cache[question_id] = explanation
-        session["ai_explanation_cache"] = ai_explanation_cache
-        
         # 計算本次請求的 token 數
         current_tokens = response.usage_metadata.total_token_count
+
+        # 步驟 3: 將新的詳解存入快取，session 只記錄參照
+        remember_explanation(question_id, prompt, explanation, current_tokens)
         
         # 更新累積 token 數
         total_tokens_used += current_tokens
@@ -298,6 +422,8 @@ def get_ai_explanation():
             "current_tokens": current_tokens,
             "total_tokens": total_tokens_used
         })
+    except RateLimitTimeout as e:
+        return jsonify({"error": str(e)}), 429
     except Exception as e:
         print(f"Gemini API 呼叫失敗: {e}")
         return jsonify({"error": "無法取得 AI 詳解，請稍後再試。"}), 500
@@ -315,66 +441,89 @@ def stream_ai_explanation():
     if not api_key:
         return jsonify({"error": "缺少 API Key"}), 403
 
-    client = genai.Client(api_key=api_key)
+    # 同一把 API Key 沿用既有的 client 與連線，並共用同一個限流器
+    client = client_pool.get(api_key)
+    limiter = rate_limiter_for(api_key)
 
     # 取得題目
     is_detail = request.args.get("detail", "false").lower() == "true"
     data = request.json
-    question = data.get("question")
+    question = resolve_question(data.get("question"))
     question_id = question["題號"]
+    prompt = build_prompt(question, is_detail)
 
-    # 從 session 取得 AI 詳解快取
-    ai_explanation_cache = session.get("ai_explanation_cache", {})
-    
-    # 步驟 1: 檢查 session 快取中是否有詳解
-    if question_id in ai_explanation_cache:
-        print(f"✅ 題號 {question_id} 的詳解已從 Session 快取中取得。")
-        explanation = ai_explanation_cache[question_id]
+    # 步驟 1: 檢查所有使用者共用的詳解快取（題號 + prompt）
+    explanation = shared_explanation(question_id, prompt)
+    if explanation is not None:
+        print(f"✅ 題號 {question_id} 的詳解已從快取中取得。")
         return jsonify({
             "explanation": explanation,
             "current_tokens": 0,
             "total_tokens": total_tokens_used
         })
 
-    # 步驟 2: 如果 session 快取中沒有，則執行 API 呼叫
+    # 步驟 2: 如果快取中沒有，則執行 API 呼叫
 
-    prompt = f"請以繁體中文，針對以下問題，生成 1 分鐘內可以閱讀完的詳解，包含關鍵概念和每個選項解釋，文字簡明，重點清楚：\n\n題目：{question['題目']}\n選項：{' '.join(question['選項'])}\n答案：{question['答案']}"
-    if is_detail:
-        prompt = f"請以繁體中文，針對以下問題提供詳細的解釋：\n\n題目：{question['題目']}\n選項：{' '.join(question['選項'])}\n答案：{question['答案']}"
-    
     # 確保 prompt_tokens 在串流開始前計算一次
     # 因為 prompt tokens 在發送請求時就已確定
     # prompt_tokens = client.models.count_tokens(model=MODEL, contents=prompt).total_tokens
 
+    sid = session.sid
+
     def generate_stream():
-        total_tokens_in_stream = session.get("total_tokens_used", 0)
-        try:
-            full_explanation = ""
-            response = client.models.generate_content_stream(
-                model=MODEL,
-                contents=prompt
+        full_explanation = ""
+        current_tokens = 0
+        if ai_runner is not None:
+            # 非同步模式：上游串流在共用 event loop 上執行
+            response = ai_runner.stream(client, MODEL, prompt, limiter, sid)
+        else:
+            response = limiter.stream(
+                lambda: client.models.generate_content_stream(
+                    model=MODEL,
+                    contents=prompt
+                ),
+                sid,
             )
+        try:
             # 呼叫 genai API 並啟用串流
             for chunk in response:
+                # 先累積再送出：瀏覽器離線時 GeneratorExit 會在 yield 拋出，
+                # 正在送出的片段與 token 數仍需交給 drain_stream 寫入快取
+                if (chunk.usage_metadata):
+                    current_tokens = chunk.usage_metadata.total_token_count or 0
                 if (chunk.text):
-                    yield chunk.text.encode('utf-8')
                     full_explanation += chunk.text
-                if (chunk.usage_metadata):
-                    current_tokens = chunk.usage_metadata.total_token_count
-                    total_tokens_in_stream += current_tokens
-                    session["total_tokens_used"] = total_tokens_in_stream
-                    token_info = {
-                        "current_tokens": current_tokens,
-                        "total_tokens": total_tokens_in_stream
-                    }
-            
-            # 將 JSON 資訊傳送給前端
-            yield f"<div data-tokens='{json.dumps(token_info)}' style='display:none;'></div>".encode('utf-8')
-
+                    yield chunk.text.encode('utf-8')
+        except GeneratorExit:
+            # 瀏覽器中途離線
+            if AI_DISCONNECT == "finish":
+                # 在背景讀完上游串流，完整的詳解仍寫入快取
+                threading.Thread(
+                    target=drain_stream,
+                    args=(response, sid, question_id, prompt, full_explanation, current_tokens),
+                    daemon=True,
+                ).start()
+            else:
+                # 立即關閉上游請求，只記錄已使用的 token
+                close_stream(response)
+                record_stream(sid, question_id, prompt, None, current_tokens)
+            raise
         except Exception as e:
-            # 處理可能發生的 API 錯誤
+            # 處理可能發生的 API 錯誤；中斷前已使用的 token 仍需記錄
+            close_stream(response)
+            record_stream(sid, question_id, prompt, None, current_tokens)
             error_message = f"無法取得 AI 詳解：{e}"
             yield f'<p style="color:red;">{error_message}</p>'.encode('utf-8')
+            return
+
+        total_tokens_used = record_stream(sid, question_id, prompt, full_explanation, current_tokens)
+        token_info = {
+            "current_tokens": current_tokens,
+            "total_tokens": total_tokens_used
+        }
+
+        # 將 JSON 資訊傳送給前端
+        yield f"<div data-tokens='{json.dumps(token_info)}' style='display:none;'></div>".encode('utf-8')
 
     # 這裡回傳 Response 物件，並將生成器函式作為回應內容
     # mimetype 設為 text/html，讓瀏覽器能直接解析 HTML 標籤
@@ -384,6 +533,72 @@ def stream_ai_explanation():
 # 並將其儲存在一個全域字典中。
 # 此字典的鍵為檔案名稱，值為題目列表。
 ALL_QUESTIONS_DATA = {}
+# 每個題庫的 題號 -> 題庫內位置，啟動（或重新載入）時建立一次
+BANK_POSITIONS = {}
+# 每個題庫依位置排列的題號，與 BANK_POSITIONS 一起在 master 建立，組合題庫時不必解碼題目
+BANK_IDS = {}
+
+# 選定題庫組合的位置索引：stems 為題庫名稱，starts[i] 為第 i 個題庫在組合中的起始位置，
+# ids 為組合中所有題號（依位置排列），digest 為 (題數, 題號清單雜湊)，用來確認 session 中的位置仍然有效
+Selection = namedtuple("Selection", "stems starts ids digest")
+
+@lru_cache(maxsize=256)
+def get_selection(stems):
+    """回傳選定題庫組合的位置索引；題庫重新載入時會清除。"""
+    starts = []
+    ids = []
+    for stem in stems:
+        starts.append(len(ids))
+        ids.extend(BANK_IDS.get(stem, ()))
+    digest = hashlib.sha1("\n".join(ids).encode("utf-8")).hexdigest()
+    return Selection(stems, starts, ids, (len(ids), digest))
+
+def current_selection():
+    stems = session.get("selected_question_sets")
+    if not stems:
+        return None
+    return get_selection(tuple(stems))
+
+def current_quiz_state(selection):
+    """取得 session 中的作答狀態，並確認其中的位置仍對應目前載入的題庫。
+
+    session 可保存數十天，期間題庫檔案可能被修改或重新載入；題號清單不同時，
+    已答題目與出題順序等位置資料改為重新開始，錯題與標記（題號）則保留仍存在的題目。
+    """
+    state = session.get("quiz_state")
+    if selection is None or state is None:
+        return state
+    if session.get("quiz_selection") != selection.digest:
+        fresh = QuizState(len(selection.ids))
+        fresh.set_wrong(q_id for q_id in state.wrong if position_of(selection, q_id) is not None)
+        fresh.marked = dict.fromkeys(
+            q_id for q_id in state.marked if position_of(selection, q_id) is not None
+        )
+        session["quiz_state"] = state = fresh
+        session["quiz_selection"] = selection.digest
+    return state
+
+def question_at(selection, position):
+    # 空題庫與下一個題庫起始位置相同，bisect_right 會取到有題目的那一個
+    i = bisect.bisect_right(selection.starts, position) - 1
+    return ALL_QUESTIONS_DATA[selection.stems[i]][position - selection.starts[i]]
+
+def position_of(selection, question_id):
+    """題號在選定題庫組合中的位置；題號重複時以先選的題庫為準。"""
+    for stem, start in zip(selection.stems, selection.starts):
+        position = BANK_POSITIONS.get(stem, {}).get(question_id)
+        if position is not None:
+            return start + position
+    return None
+
+def question_by_id(selection, question_id):
+    position = position_of(selection, question_id)
+    return None if position is None else question_at(selection, position)
+
+def questions_by_ids(selection, question_ids):
+    if selection is None:
+        return []
+    return [q for q in (question_by_id(selection, q_id) for q_id in question_ids) if q is not None]
 
 def load_all_question_files():
     """在應用程式啟動時載入所有題庫檔案一次。"""
@@ -391,23 +606,40 @@ def load_all_question_files():
     json_path = base_dir / 'json'
     available_jsons = sorted(json_path.glob("*.json"))
 
-    for file_path in available_jsons:
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, list):
-                    # 處理並儲存每個題庫，鍵為檔案名稱
-                    ALL_QUESTIONS_DATA[file_path.stem] = data
-                    print(f"✅ 載入檔案：{file_path.stem}，題數：{len(data)}")
-                else:
-                    print(f"⚠️ {file_path} 格式錯誤，非陣列，略過")
-        except json.JSONDecodeError:
+    ALL_QUESTIONS_DATA.clear()
+    BANK_POSITIONS.clear()
+    BANK_IDS.clear()
+    get_selection.cache_clear()
+    results = question_bank.load_question_files(
+        available_jsons, question_bank.read_raw_question_file, workers=LOAD_WORKERS
+    )
+    for result in results:
+        file_path, bank, error = result["path"], result["bank"], result["error"]
+        if isinstance(error, json.JSONDecodeError):
             print(f"⚠️ {file_path} 無法解析為 JSON，略過")
-        except Exception as e:
-            print(f"❌ 處理檔案 {file_path} 時發生錯誤：{e}")
+        elif isinstance(error, ValueError):
+            print(f"⚠️ {file_path} 格式錯誤，非陣列，略過")
+        elif error is not None:
+            print(f"❌ 處理檔案 {file_path} 時發生錯誤：{error}")
+        else:
+            # 處理並儲存每個題庫，鍵為檔案名稱
+            # 以精簡的唯讀格式保存，fork 後各 worker 可共用同一份記憶體
+            ALL_QUESTIONS_DATA[file_path.stem] = question_bank.FrozenBank(bank["questions"])
+            BANK_IDS[file_path.stem] = tuple(q["題號"] for q in bank["questions"])
+            positions = BANK_POSITIONS[file_path.stem] = {}
+            for i, q in enumerate(bank["questions"]):
+                # 題庫內題號重複時保留第一題，與 list.index 的結果相同
+                positions.setdefault(q["題號"], i)
+            source = "（快取）" if result["from_cache"] else ""
+            print(
+                f"✅ 載入檔案：{file_path.stem}{source}，題數：{len(bank['questions'])}"
+                f"，耗時 {result['seconds']:.3f} 秒"
+            )
 
 # 在應用程式啟動時呼叫此函數
 load_all_question_files()
+if not PRELOAD:
+    init_worker()
 
 # if __name__ == "__main__":
 #     import argparse
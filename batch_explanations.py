@@ -0,0 +1,109 @@
+import json
+import threading
+
+# 批次生成 AI 詳解：把多題合併成一個要求 JSON 輸出的請求，說明文字只需送出一次，
+# 回傳後依題號拆回各題，分別以各自單題的 prompt 寫入快取。
+
+# Gemini 結構化輸出的格式：[{"question_id": ..., "explanation": ...}, ...]
+RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "question_id": {"type": "STRING"},
+            "explanation": {"type": "STRING"},
+        },
+        "required": ["question_id", "explanation"],
+    },
+}
+
+GENERATION_CONFIG = {
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA,
+}
+
+
+def build_batch_prompt(instructions, question_parts):
+    """組成批次 prompt：instructions 為各題共用的說明，question_parts 為 [(題號, 題目內容)]。"""
+    lines = [
+        instructions,
+        "",
+        "以下共有 {} 題，請逐題分別作答，"
+        "以 JSON 陣列回傳，每題一個物件：question_id 為題號（照抄），"
+        "explanation 為該題的解釋（Markdown）。".format(len(question_parts)),
+    ]
+    for question_id, part in question_parts:
+        lines += ["", f"### 題號：{question_id}", part]
+    return "\n".join(lines)
+
+
+def parse_batch_response(text, question_ids):
+    """解析批次回應，回傳 {題號: 詳解}，只包含 question_ids 中且內容非空的題目。
+
+    回應不是預期的 JSON 格式時拋出 ValueError。
+    """
+    data = json.loads(text)
+    if isinstance(data, dict):
+        # 有些回應會以物件包住陣列
+        data = next((value for value in data.values() if isinstance(value, list)), None)
+    if not isinstance(data, list):
+        raise ValueError("批次回應不是 JSON 陣列")
+    wanted = set(question_ids)
+    explanations = {}
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        question_id = str(item.get("question_id", "")).strip()
+        explanation = item.get("explanation")
+        if question_id in wanted and isinstance(explanation, str) and explanation.strip():
+            explanations.setdefault(question_id, explanation.strip())
+    return explanations
+
+
+def split_tokens(tokens, explanations):
+    """依詳解長度分攤批次使用的 token 數，供各題快取記錄。"""
+    total = sum(len(text) for text in explanations.values())
+    if not total:
+        return {question_id: 0 for question_id in explanations}
+    return {
+        question_id: tokens * len(text) // total
+        for question_id, text in explanations.items()
+    }
+
+
+class BatchJob:
+    """背景批次生成工作的進度；由執行批次的執行緒更新，網頁輪詢 snapshot() 顯示進度。"""
+
+    def __init__(self, total, batches, cached=0):
+        self.total = total
+        self.cached = cached
+        self.generated = 0
+        self.failed = []
+        self.tokens = 0
+        self._remaining_batches = batches
+        self._lock = threading.Lock()
+
+    def record(self, explanations, tokens, errors):
+        """記錄一個批次的結果（generate_explanation_batch 的回傳值）。"""
+        with self._lock:
+            self.generated += len(explanations)
+            self.tokens += tokens
+            self.failed.extend(errors)
+            self._remaining_batches -= 1
+
+    def record_failure(self, question_ids):
+        """整個批次意外失敗時，將其中的題目記為失敗。"""
+        with self._lock:
+            self.failed.extend(question_ids)
+            self._remaining_batches -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "total": self.total,
+                "cached": self.cached,
+                "generated": self.generated,
+                "failed": list(self.failed),
+                "current_tokens": self.tokens,
+                "finished": self._remaining_batches <= 0,
+            }
@@ -0,0 +1,65 @@
+import threading
+import time
+from collections import OrderedDict
+
+# 依 API Key 重複使用 Gemini client：同一位使用者之後的請求沿用既有的 HTTP 連線 (keep-alive)，
+# 不必每次重新建立 client 與 TLS 連線。
+
+
+class ClientPool:
+    """執行緒安全、有上限的 client 池，以 API Key 為鍵。
+
+    超過 max_clients 時移除最久未使用的 client；閒置超過 idle_seconds 的 client 會被關閉。
+    """
+
+    def __init__(self, factory, max_clients=64, idle_seconds=600):
+        self.factory = factory
+        self.max_clients = max_clients
+        self.idle_seconds = idle_seconds
+        self.created = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()  # api_key -> (client, last_used)
+
+    def get(self, api_key):
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._clients.get(api_key)
+            if entry is not None:
+                self._clients[api_key] = (entry[0], now)
+                self._clients.move_to_end(api_key)
+                self.reused += 1
+                return entry[0]
+        # 建立 client 不持有鎖，避免阻塞其他使用者；同時建立時以先放入者為準
+        client = self.factory(api_key=api_key)
+        with self._lock:
+            entry = self._clients.get(api_key)
+            if entry is not None:
+                self.reused += 1
+                return entry[0]
+            self._clients[api_key] = (client, now)
+            self.created += 1
+            while len(self._clients) > self.max_clients:
+                # 可能仍有串流在使用，只移除參照，連線在 client 被回收時釋放
+                self._clients.popitem(last=False)
+        return client
+
+    def stats(self):
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "created": self.created,
+                "reused": self.reused,
+            }
+
+    def _expire(self, now):
+        """關閉閒置過久的 client；呼叫端需持有鎖。"""
+        while self._clients:
+            api_key, (client, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_seconds:
+                break
+            del self._clients[api_key]
+            close = getattr(client, "close", None)
+            if callable(close):
+                close()
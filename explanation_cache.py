@@ -0,0 +1,223 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# AI 詳解的持久化快取：以 (題號, prompt 雜湊) 為鍵存在 SQLite (WAL 模式)
+# 重新啟動後仍可直接取用，不必再花費 Gemini token
+# prompt 由題目與模式（詳細、公正、單一選項…）決定，因此同一題的每種模式各自保存一筆，
+# variant 欄位記錄模式名稱供總覽頁顯示；最近使用的詳解另外保存在記憶體中
+
+
+# 記憶體命中的存取時間累積到這個筆數或秒數時寫回 SQLite
+TOUCH_FLUSH_ENTRIES = 100
+TOUCH_FLUSH_SECONDS = 60
+
+
+def prompt_hash(prompt):
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+class ExplanationCache:
+    """AI 詳解快取，支援筆數上限與保存天數的淘汰機制，並統計命中次數。
+
+    max_entries 超過時淘汰最久未使用的詳解；max_age_days 為 None 表示不依時間淘汰。
+    memory_entries 為記憶體中 LRU 的筆數，命中時不必查詢 SQLite。
+    """
+
+    def __init__(self, path, max_entries=5000, max_age_days=None, memory_entries=256):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.memory_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # (題號, prompt 雜湊) -> 詳解
+        # 記憶體命中的存取時間，累積後批次寫回 SQLite，淘汰時才不會誤刪常用的詳解
+        self._touched = {}  # (題號, prompt 雜湊) -> 最後存取時間
+        self._touched_flushed_at = time.monotonic()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS explanations (
+                question_id TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                explanation TEXT NOT NULL,
+                variant TEXT NOT NULL DEFAULT '',
+                tokens INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (question_id, prompt_hash)
+            )"""
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(explanations)")]
+        if "variant" not in columns:
+            # 舊版快取檔案沒有 variant 欄位
+            self._conn.execute(
+                "ALTER TABLE explanations ADD COLUMN variant TEXT NOT NULL DEFAULT ''"
+            )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS explanations_accessed_at"
+            " ON explanations (accessed_at)"
+        )
+        with self._lock:
+            self._evict()
+            self._conn.commit()
+
+    def get(self, question_id, prompt):
+        """取得詳解；沒有快取時回傳 None。"""
+        return self.get_by_hash(question_id, prompt_hash(prompt))
+
+    def get_by_hash(self, question_id, digest):
+        """以 prompt 雜湊取得詳解（供只保存雜湊作為參照的 session 使用）。"""
+        key = (question_id, digest)
+        with self._lock:
+            explanation = self._memory.get(key)
+            if explanation is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                self._touched[key] = time.time()
+                if (
+                    len(self._touched) >= TOUCH_FLUSH_ENTRIES
+                    or time.monotonic() - self._touched_flushed_at >= TOUCH_FLUSH_SECONDS
+                ):
+                    self._flush_touched()
+                    self._conn.commit()
+                return explanation
+            row = self._conn.execute(
+                "SELECT explanation FROM explanations"
+                " WHERE question_id = ? AND prompt_hash = ?",
+                (question_id, digest),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute(
+                "UPDATE explanations SET accessed_at = ?"
+                " WHERE question_id = ? AND prompt_hash = ?",
+                (time.time(), question_id, digest),
+            )
+            self._conn.commit()
+            self._remember(key, row[0])
+            return row[0]
+
+    def get_many_by_hash(self, refs):
+        """批次以 {題號: prompt 雜湊} 取得詳解，回傳 {題號: 詳解}，不計入命中統計。"""
+        result = {}
+        with self._lock:
+            for question_id, digest in refs.items():
+                row = self._conn.execute(
+                    "SELECT explanation FROM explanations"
+                    " WHERE question_id = ? AND prompt_hash = ?",
+                    (question_id, digest),
+                ).fetchone()
+                if row is not None:
+                    result[question_id] = row[0]
+        return result
+
+    def has(self, question_id, prompt):
+        """檢查是否已有詳解，不計入命中統計。"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM explanations WHERE question_id = ? AND prompt_hash = ?",
+                (question_id, prompt_hash(prompt)),
+            ).fetchone()
+        return row is not None
+
+    def put(self, question_id, prompt, explanation, tokens=0, variant=""):
+        now = time.time()
+        digest = prompt_hash(prompt)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO explanations"
+                " (question_id, prompt_hash, prompt, explanation, variant, tokens,"
+                " created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (question_id, digest, prompt, explanation, variant, tokens, now, now),
+            )
+            self._evict()
+            self._conn.commit()
+            self._remember((question_id, digest), explanation)
+
+    def variants_all(self):
+        """回傳 {題號: [(模式名稱, 詳解), ...]}，每題的所有模式依生成時間排列。"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT question_id, variant, explanation FROM explanations"
+                " ORDER BY created_at"
+            ).fetchall()
+        variants = {}
+        for question_id, variant, explanation in rows:
+            variants.setdefault(question_id, []).append((variant, explanation))
+        return variants
+
+    def stats(self):
+        with self._lock:
+            entries, tokens = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(tokens), 0) FROM explanations"
+            ).fetchone()
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": entries,
+            "tokens": tokens,
+        }
+
+    def _remember(self, key, explanation):
+        """放入記憶體 LRU；呼叫端需持有鎖。"""
+        if not self.memory_entries:
+            return
+        self._memory[key] = explanation
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _flush_touched(self):
+        """將記憶體命中的存取時間寫回 SQLite；呼叫端需持有鎖並負責 commit。"""
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE explanations SET accessed_at = MAX(accessed_at, ?)"
+                " WHERE question_id = ? AND prompt_hash = ?",
+                [(at, question_id, digest) for (question_id, digest), at in self._touched.items()],
+            )
+            self._touched.clear()
+        self._touched_flushed_at = time.monotonic()
+
+    def _evict(self):
+        """淘汰過期與超過筆數上限的詳解，並一併移出記憶體 LRU；呼叫端需持有鎖。"""
+        # 先寫回記憶體命中的存取時間，筆數上限才會依實際的最近使用時間淘汰
+        self._flush_touched()
+        if self.max_age_days is not None:
+            cutoff = time.time() - self.max_age_days * 24 * 60 * 60
+            self._delete(
+                "SELECT rowid, question_id, prompt_hash FROM explanations"
+                " WHERE created_at < ?",
+                (cutoff,),
+            )
+        if self.max_entries is not None:
+            self._delete(
+                "SELECT rowid, question_id, prompt_hash FROM explanations"
+                " ORDER BY accessed_at DESC LIMIT -1 OFFSET ?",
+                (self.max_entries,),
+            )
+
+    def _delete(self, query, params):
+        """刪除 query 選出的 (rowid, 題號, prompt 雜湊)；呼叫端需持有鎖。"""
+        rows = self._conn.execute(query, params).fetchall()
+        if not rows:
+            return
+        self._conn.executemany(
+            "DELETE FROM explanations WHERE rowid = ?", [(row[0],) for row in rows]
+        )
+        for _, question_id, digest in rows:
+            self._memory.pop((question_id, digest), None)
+            self._touched.pop((question_id, digest), None)
@@ -0,0 +1,64 @@
+import asyncio
+import queue
+import threading
+
+# 以單一背景執行緒上的 asyncio event loop 執行 Gemini 非同步串流 (client.aio)。
+# 所有上游串流共用這個 loop，不必為每個串流佔用一個執行緒。
+# 注意：WSGI 路由以 stream() 同步讀取時，處理請求的執行緒仍會等到串流結束；
+# 可同時服務的串流數由 WSGI server 的執行緒數決定（app.py 見 gunicorn.conf.py）。
+
+_DONE = object()
+
+
+class AsyncGeminiRunner:
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="gemini-async", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, coro):
+        """在 event loop 上執行 coroutine，回傳 concurrent.futures.Future。"""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def stream(self, client, model, prompt, limiter=None, user=""):
+        """同步讀取非同步串流的片段，供 WSGI 路由的產生器使用。
+
+        讀取端中途停止（例如瀏覽器關閉連線）時會取消上游請求。
+        指定 limiter（rate_limiter.RateLimiter）時，請求以 user 的身分排隊取得額度。
+        """
+        chunks = queue.Queue()
+
+        def open_stream():
+            return client.aio.models.generate_content_stream(
+                model=model, contents=prompt
+            )
+
+        async def pump():
+            try:
+                if limiter is not None:
+                    response = limiter.astream(open_stream, user)
+                else:
+                    response = await open_stream()
+                async for chunk in response:
+                    chunks.put(chunk)
+            except Exception as e:
+                chunks.put(e)
+            finally:
+                chunks.put(_DONE)
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item = chunks.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
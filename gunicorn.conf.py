@@ -0,0 +1,27 @@
+import gc
+import os
+
+# gunicorn 啟動時會自動讀取此設定檔（gunicorn app:app）。
+# 題庫在 master 行程載入一次，worker 以 fork 共用記憶體分頁 (copy-on-write)；
+# 設定 QBANK_PRELOAD=0 可改回每個 worker 各自載入題庫。
+os.environ.setdefault("QBANK_PRELOAD", "1")
+preload_app = os.environ["QBANK_PRELOAD"] == "1"
+
+# 串流詳解會佔住處理請求的執行緒直到生成結束；預設的 sync worker 一次只處理一個請求，
+# 一條串流就會卡住同一個 worker 的其他使用者。改用執行緒 worker，每個 worker 可同時處理
+# QBANK_THREADS 個請求（同時進行的串流數上限為 worker 數 × 執行緒數）。
+worker_class = os.environ.get("QBANK_WORKER_CLASS", "gthread")
+threads = int(os.environ.get("QBANK_THREADS", "32"))
+
+
+def pre_fork(server, worker):
+    # 將 master 中已載入的物件移出 GC 追蹤，worker 的 GC 就不會寫入這些共用分頁
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import app
+
+        # SQLite 連線與 event loop 執行緒不能跨 fork 共用，在 worker 中重新建立
+        app.init_worker()
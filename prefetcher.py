@@ -0,0 +1,66 @@
+import threading
+
+# 預先生成：使用者作答時，在背景為下一題生成 AI 詳解並寫入快取，
+# 按下詳解按鈕時即可直接從快取取得。
+
+
+class Prefetcher:
+    """限制同時進行的預先生成數量與 token 總量。
+
+    start(question_id, prompt, variant) 需回傳 (flight, started)，
+    通常為 quiz_web.start_explanation，與一般請求共用同一個生成過程。
+    """
+
+    def __init__(self, start, max_inflight=2, token_budget=None):
+        self.start = start
+        self.max_inflight = max_inflight
+        self.token_budget = token_budget
+        self.spent_tokens = 0
+        self.started = 0
+        self.skipped = 0
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def submit(self, question_id, prompt, variant=""):
+        """嘗試開始預先生成；超過同時數量或 token 上限時略過，回傳是否開始。"""
+        with self._lock:
+            if self.budget_exhausted() or self._inflight >= self.max_inflight:
+                self.skipped += 1
+                return False
+            self._inflight += 1
+        try:
+            flight, started = self.start(question_id, prompt, variant)
+        except Exception:
+            self._release(0)
+            raise
+        if not started:
+            # 已有相同的生成正在進行
+            self._release(0)
+            return False
+        with self._lock:
+            self.started += 1
+        threading.Thread(target=self._watch, args=(flight,), daemon=True).start()
+        return True
+
+    def budget_exhausted(self):
+        return self.token_budget is not None and self.spent_tokens >= self.token_budget
+
+    def stats(self):
+        with self._lock:
+            return {
+                "inflight": self._inflight,
+                "started": self.started,
+                "skipped": self.skipped,
+                "spent_tokens": self.spent_tokens,
+                "token_budget": self.token_budget,
+            }
+
+    def _watch(self, flight):
+        # 以 wait() 作為讀取端，--ai-disconnect cancel 時預先生成不會因無人讀取而被取消
+        flight.wait()
+        self._release(flight.tokens)
+
+    def _release(self, tokens):
+        with self._lock:
+            self._inflight -= 1
+            self.spent_tokens += tokens
@@ -0,0 +1,212 @@
+import json
+import multiprocessing
+import os
+import re
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from search_index import SearchIndex, search_text
+
+# 編譯快取：每個題庫 JSON 對應一個快取檔，放在題庫旁的 .qbank_cache 資料夾
+# 來源檔案路徑、大小、修改時間（以及圖片資料夾修改時間）不變時直接讀取快取
+# 題庫資料夾可能來自他人，快取只使用純資料格式（JSON），不使用 pickle，讀取時不會執行任何程式碼
+CACHE_DIR_NAME = ".qbank_cache"
+CACHE_VERSION = 3
+
+
+def read_quiz_file(file_path):
+    """讀取 quiz_web.py 使用的題庫：整理題目/選項換行、補上題號前綴並找出對應圖片。
+
+    回傳 {"questions": [...], "images": {題號: (圖片路徑, 修改時間)}, "search": 搜尋索引}，
+    搜尋索引為 SearchIndex.to_data() 的純資料，與題目一起寫入編譯快取。
+    """
+    file_path = Path(file_path)
+    image_folder = file_path.parent / (file_path.stem + "_images")
+    # 圖片資料夾只掃描一次，建立 檔名(不含副檔名) -> 路徑 的對照表
+    image_files = {}
+    if image_folder.exists():
+        image_files = {image.stem: image for image in image_folder.glob("*.png")}
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError("格式錯誤，非陣列")
+
+    images = {}
+    for q in data:
+        if "題目" in q:
+            q["題目"] = q["題目"].replace("\r\n", " ").replace("\n", " ").strip()
+        if "選項" in q and isinstance(q["選項"], list):
+            q["選項"] = [
+                opt.replace("\r\n", " ").replace("\n", " ").strip() for opt in q["選項"]
+            ]
+        match = re.match(r"^(.*?)(?:_\d+)$", q["題號"])
+        question_stem = "預設"
+        if match:
+            question_stem = match.group(1)
+        if "題號" in q and question_stem not in f"{file_path.stem}":
+            q["題號"] = f"{file_path.stem}_{q.get('題號')}"
+            # 如果圖片資料夾中有與題號相同的圖片，記錄路徑，圖片本身不讀入
+            image_file = image_files.get(q["題號"])
+            if image_file is not None:
+                images[q["題號"]] = (str(image_file), image_file.stat().st_mtime_ns)
+    search = SearchIndex.build([search_text(q) for q in data]).to_data()
+    return {"questions": data, "images": images, "search": search}
+
+
+def read_raw_question_file(file_path):
+    """讀取 app.py 使用的題庫：原樣載入 JSON 陣列。"""
+    with open(file_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError("格式錯誤，非陣列")
+    return {"questions": data, "images": {}}
+
+
+def cache_path_for(file_path, reader):
+    file_path = Path(file_path)
+    return (
+        file_path.parent / CACHE_DIR_NAME / f"{file_path.name}.{reader.__name__}.json"
+    )
+
+
+def source_key(file_path, reader):
+    """快取鍵：來源路徑、大小、修改時間與圖片資料夾修改時間。"""
+    file_path = Path(file_path).resolve()
+    stat = file_path.stat()
+    image_folder = file_path.parent / (file_path.stem + "_images")
+    image_mtime = image_folder.stat().st_mtime_ns if image_folder.exists() else None
+    return [
+        CACHE_VERSION,
+        reader.__name__,
+        str(file_path),
+        stat.st_size,
+        stat.st_mtime_ns,
+        image_mtime,
+    ]
+
+
+def refresh_image_versions(images):
+    """重新讀取圖片的修改時間作為版本。
+
+    覆寫既有圖片（例如重新執行 pdfgetimg.py）不一定會改變資料夾的修改時間，
+    快取中的版本需在載入時更新，瀏覽器才會取得新圖片；已刪除的圖片一併移除。
+    """
+    refreshed = {}
+    for question_id, (image_path, _) in images.items():
+        try:
+            refreshed[question_id] = (image_path, os.stat(image_path).st_mtime_ns)
+        except OSError:
+            pass
+    return refreshed
+
+
+def load_question_file(file_path, reader=read_quiz_file, use_cache=True):
+    """讀取單一題庫，優先使用編譯快取；回傳 (bank, 是否來自快取)。
+
+    JSON 解析錯誤或格式錯誤（ValueError）會直接拋出，由呼叫端決定如何提示。
+    """
+    if not use_cache:
+        return reader(file_path), False
+
+    key = source_key(file_path, reader)
+    cache_path = cache_path_for(file_path, reader)
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("key") == key:
+            bank = cached["bank"]
+            bank["images"] = refresh_image_versions(bank["images"])
+            return bank, True
+    except (OSError, ValueError, AttributeError, KeyError, TypeError):
+        pass
+
+    bank = reader(file_path)
+    try:
+        cache_path.parent.mkdir(exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"key": key, "bank": bank}, f, ensure_ascii=False, separators=(",", ":")
+            )
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"⚠️ 無法寫入題庫快取 {cache_path}：{e}")
+    return bank, False
+
+
+def _load_timed(job):
+    """平行載入的工作單元：回傳可在行程間傳遞的結果與耗時。"""
+    file_path, reader, use_cache = job
+    start = time.perf_counter()
+    result = {"path": file_path, "bank": None, "from_cache": False, "error": None}
+    try:
+        result["bank"], result["from_cache"] = load_question_file(
+            file_path, reader, use_cache
+        )
+    except json.JSONDecodeError as e:
+        # 不把整份文件內容 (e.doc) 傳回主行程
+        result["error"] = json.JSONDecodeError(e.msg, "", 0)
+    except ValueError as e:
+        result["error"] = e
+    except Exception as e:
+        result["error"] = Exception(str(e))
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def load_question_files(file_paths, reader=read_quiz_file, use_cache=True, workers=1):
+    """載入多個題庫，回傳與 file_paths 順序相同的結果列表。
+
+    workers > 1 時使用多個行程平行解析；每筆結果包含 path、bank、from_cache、
+    error 與 seconds（該檔案的載入耗時）。
+    """
+    jobs = [(Path(p), reader, use_cache) for p in file_paths]
+    if workers <= 1 or len(jobs) <= 1:
+        return [_load_timed(job) for job in jobs]
+    # 使用 spawn 而非 fork：呼叫時行程中可能已有背景執行緒（AI 執行器、作答紀錄）與 SQLite 連線，
+    # fork 只複製目前的執行緒，子行程可能卡在被複製時已鎖住的鎖上
+    executor = ProcessPoolExecutor(
+        max_workers=min(workers, len(jobs)),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    with executor:
+        # map 會依照輸入順序回傳，確保題目順序固定
+        return list(executor.map(_load_timed, jobs))
+
+
+class FrozenBank:
+    """唯讀的精簡題庫：所有題目以緊湊 JSON 串接成單一 bytes，另以 array 記錄每題的起始位置。
+
+    整個題庫只有兩個物件，fork 後 worker 讀取題目不會因參照計數寫入共用的記憶體分頁；
+    每次取題時才解碼成新的 dict，呼叫端可以自由修改。
+    """
+
+    __slots__ = ("_blob", "_offsets")
+
+    def __init__(self, questions):
+        parts = [
+            json.dumps(q, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            for q in questions
+        ]
+        offsets = array("Q", [0])
+        for part in parts:
+            offsets.append(offsets[-1] + len(part))
+        self._blob = b"".join(parts)
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("題目索引超出範圍")
+        return json.loads(self._blob[self._offsets[index] : self._offsets[index + 1]])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
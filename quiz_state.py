@@ -0,0 +1,176 @@
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
+
+# 每位使用者的作答狀態。題庫本身由所有使用者共用且唯讀，
+# 這裡只保存精簡的結構：已答題目的 bitset、錯題/標記的題號清單與出題位置。
+
+
+class QuizState:
+    def __init__(self, size):
+        self.size = size
+        # 已答題目：以題目索引為位元的 bitset
+        self.answered = bytearray((size + 7) // 8)
+        self.answered_count = 0
+        # 錯題與標記題目：題號 -> None（dict 保留加入順序，查詢 O(1)）
+        self.wrong = {}
+        self.marked = {}
+        # 錯題模式的出題順序（題號），以 deque 輪替
+        self.wrong_queue = deque()
+        self.wrong_answer_count = 0
+        self.question_index = 0
+        self.prev_question_index = 0
+        # 隨機模式的排列，第一次使用隨機模式時才建立
+        self.random_order = None
+        self.random_cursor = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # 鎖無法序列化；app.py 會將整個狀態 pickle 存入伺服器端 session
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def copy(self):
+        state = QuizState(self.size)
+        state.answered = bytearray(self.answered)
+        state.answered_count = self.answered_count
+        state.wrong = dict(self.wrong)
+        state.marked = dict(self.marked)
+        state.wrong_queue = deque(self.wrong_queue)
+        state.wrong_answer_count = self.wrong_answer_count
+        state.question_index = self.question_index
+        state.prev_question_index = self.prev_question_index
+        if self.random_order is not None:
+            state.random_order = array("I", self.random_order)
+        state.random_cursor = self.random_cursor
+        return state
+
+    def is_answered(self, index):
+        return bool(self.answered[index >> 3] & (1 << (index & 7)))
+
+    def mark_answered(self, index):
+        if not self.is_answered(index):
+            self.answered[index >> 3] |= 1 << (index & 7)
+            self.answered_count += 1
+
+    def answered_indices(self):
+        return (i for i in range(self.size) if self.is_answered(i))
+
+    def reset(self):
+        self.answered = bytearray(len(self.answered))
+        self.answered_count = 0
+        # 排列本身仍是合法的排列，從頭繼續洗牌即可
+        self.random_cursor = 0
+        self.question_index = 0
+
+    def set_wrong(self, question_ids):
+        self.wrong = dict.fromkeys(question_ids)
+        self.wrong_queue = deque(self.wrong)
+
+    def add_wrong(self, question_id):
+        if question_id not in self.wrong:
+            self.wrong[question_id] = None
+            self.wrong_queue.append(question_id)
+
+    def next_wrong(self, rng):
+        """取出最前面的錯題題號並輪到最後；每輪結束後重新洗牌。"""
+        question_id = self.wrong_queue[0]
+        self.wrong_answer_count += 1
+        self.wrong_queue.rotate(-1)
+        if self.wrong_answer_count >= len(self.wrong_queue):
+            self.wrong_answer_count = 0
+            shuffled = list(self.wrong_queue)
+            rng.shuffle(shuffled)
+            self.wrong_queue = deque(shuffled)
+        return question_id
+
+    def toggle_marked(self, question_id):
+        """切換標記狀態，回傳切換後是否為已標記。"""
+        if question_id in self.marked:
+            del self.marked[question_id]
+            return False
+        self.marked[question_id] = None
+        return True
+
+    def draw_random_index(self, rng):
+        """從尚未作答的題目中隨機抽一題，回傳題目索引；沒有剩餘題目時回傳 None。
+
+        以排列加上游標逐步洗牌 (lazy Fisher-Yates)，抽題與重設都只需 O(1)。
+        """
+        n = self.size
+        if self.answered_count >= n:
+            return None
+        if self.random_order is None:
+            self.random_order = array("I", range(n))
+            self.random_cursor = 0
+        order = self.random_order
+        # 最多繞兩輪：第一輪抽完後，略過但未作答的題目會在下一輪重新洗入
+        for _ in range(2 * n):
+            if self.random_cursor >= n:
+                self.random_cursor = 0
+            j = rng.randrange(self.random_cursor, n)
+            order[self.random_cursor], order[j] = order[j], order[self.random_cursor]
+            index = order[self.random_cursor]
+            self.random_cursor += 1
+            if not self.is_answered(index):
+                return index
+        return None
+
+
+class QuizSessions:
+    """以 cookie 中的 session id 對應每位使用者的 QuizState。
+
+    新使用者從 template 複製初始狀態（例如 --save / --wrong 載入的進度）；
+    超過 max_sessions 或閒置超過 idle_seconds 的狀態會被移除。
+    """
+
+    COOKIE_NAME = "qbank_sid"
+
+    def __init__(self, template, max_sessions=1000, idle_seconds=24 * 60 * 60):
+        self.template = template
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._states = OrderedDict()  # sid -> (state, last_seen)
+
+    def get(self, sid):
+        """回傳 (sid, state, created)；sid 不存在時建立新的使用者狀態。"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._states.get(sid) if sid else None
+            if entry is not None:
+                self._states[sid] = (entry[0], now)
+                self._states.move_to_end(sid)
+                return sid, entry[0], False
+            self._expire(now)
+            sid = secrets.token_urlsafe(16)
+            state = self.template.copy()
+            self._states[sid] = (state, now)
+            return sid, state, True
+
+    def reset_all(self, template):
+        """更換初始狀態並清除所有使用者（例如重新載入題庫時）。"""
+        with self._lock:
+            self.template = template
+            self._states.clear()
+
+    def _expire(self, now):
+        while self._states:
+            sid, (_, last_seen) = next(iter(self._states.items()))
+            if (
+                len(self._states) < self.max_sessions
+                and now - last_seen < self.idle_seconds
+            ):
+                break
+            del self._states[sid]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._states)
@@ -1,9 +1,47 @@
+import asyncio
 import base64
+import hashlib
 import re
-from flask import Flask, render_template, request, jsonify, Response
+import secrets
+import sys
+from flask import (
+    Flask,
+    render_template,
+    request,
+    jsonify,
+    Response,
+    abort,
+    g,
+    send_file,
+)
 import json
 import random
+import threading
+import time
+from array import array
+from collections import OrderedDict, deque
 from pathlib import Path
+from urllib.parse import quote
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+import question_bank
+from answer_journal import AnswerJournal
+from batch_explanations import (
+    GENERATION_CONFIG,
+    BatchJob,
+    build_batch_prompt,
+    parse_batch_response,
+    split_tokens,
+)
+from explanation_cache import ExplanationCache
+from gemini_async import AsyncGeminiRunner
+from quiz_state import QuizSessions, QuizState
+from prefetcher import Prefetcher
+from rate_limiter import RateLimiter, RateLimitTimeout
+from search_index import SearchIndex, keyword_grams, search_text
+from singleflight import FlightGroup
 
 # import google.generativeai as genai # 引入 Gemini SDK
 from google import genai
@@ -40,24 +78,113 @@ app = Flask(__name__)
 
 # 模擬一個儲存累積 token 數的變數
 total_tokens_used = 0
-
-# 全域資料
+tokens_lock = threading.Lock()
+
+# 進行中的 AI 詳解生成，以 (題號, prompt) 合併重複請求
+# --ai-disconnect cancel 時，所有讀取端離線就停止生成（見 singleflight.Flight）
+ai_flights = FlightGroup()
+CANCELLED_MESSAGE = "讀取端皆已離線，已停止生成"
+# --async-ai 時建立，所有 Gemini 串流在同一個 event loop 上執行
+ai_runner = None
+# Gemini 呼叫的限流器（--ai-rpm / --ai-tpm），預設不限制速率，僅在配額錯誤時重試
+rate_limiter = RateLimiter()
+# 批次生成詳解時每個請求包含的題數（--ai-batch-size），1 表示逐題生成
+ai_batch_size = 5
+# 錯題頁批次詳解在背景執行，同時進行的批次數由 --ai-batch-workers 限制
+batch_executor = ThreadPoolExecutor(max_workers=2)
+# 工作識別碼 -> BatchJob，只保留最近的 BATCH_JOBS_KEPT 個供查詢進度
+batch_jobs = OrderedDict()
+batch_jobs_lock = threading.Lock()
+BATCH_JOBS_KEPT = 100
+# --prefetch-ai 時建立，依序/錯題模式出題時在背景預先生成下一題的詳解
+prefetcher = None
+
+# 全域資料：題庫由所有使用者共用，載入後不再修改
 questions = []
-wrong_questions = []
-marked_questions = []
-question_index = 0
-remaining_questions = []
-wrong_questions_answer_count = 0
-prev_question_index = 0
 
 # 新增：建立一個全域字典來儲存題號對應的題目
 question_index_dict = {}
 
-answered_questions = set()
+# 已載入的題庫檔案（路徑、題數、題號雜湊），進度檔案以此重新對應題庫
+loaded_banks = []
+PROGRESS_VERSION = 2
+
+# 題號對應的圖片檔案路徑，由 /image/<題號> 提供
+question_images = {}
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+# 不在題庫中的錯題/標記題（例如由 --wrong 載入），以題號為鍵，所有使用者共用
+detached_questions = {}
+
+# 每位使用者的作答狀態（以 cookie 區分），初始狀態來自 --save / --wrong
+default_state = QuizState(0)
+quiz_sessions = QuizSessions(default_state)
+random_rng = random.Random()
+
+# 搜尋用倒排索引：每個題庫一個 (起始位置, SearchIndex)，索引隨題庫編譯快取保存
+search_texts = []
+search_indexes = []
 
-# 新增：建立一個全域快取字典來儲存 AI 詳解
-ai_explanation_cache = {}
-prompt_cache = {}
+# AI 詳解快取（SQLite），於啟動時依命令列參數建立
+explanation_cache = None
+# 作答紀錄 (JSON Lines)，於啟動時依命令列參數建立
+answer_journal = None
+
+
+def current_state():
+    """取得目前使用者的作答狀態；新使用者會在回應中設定 session cookie。"""
+    if "quiz_state" not in g:
+        sid, state, created = quiz_sessions.get(
+            request.cookies.get(QuizSessions.COOKIE_NAME)
+        )
+        g.quiz_state = state
+        if created:
+            g.new_quiz_sid = sid
+    return g.quiz_state
+
+
+def current_question_ids(kind):
+    """在鎖內複製目前使用者的錯題（kind="wrong"）或標記（kind="marked"）題號。
+
+    同一使用者的其他請求可能同時修改這些 dict，迭代前需先取得副本。
+    """
+    state = current_state()
+    with state.lock:
+        return list(state.wrong if kind == "wrong" else state.marked)
+
+
+@app.after_request
+def set_session_cookie(response):
+    sid = g.pop("new_quiz_sid", None)
+    if sid is not None:
+        response.set_cookie(
+            QuizSessions.COOKIE_NAME,
+            sid,
+            max_age=quiz_sessions.idle_seconds,
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+def question_by_id(question_id):
+    index = question_index_dict.get(question_id)
+    if index is not None:
+        return questions[index]
+    return detached_questions.get(question_id)
+
+
+def questions_by_ids(question_ids):
+    return [q for q in map(question_by_id, question_ids) if q is not None]
+
+
+def question_payload(state, q):
+    """回傳題目的副本並加上使用者相關欄位，避免修改共用的題庫。"""
+    return dict(
+        q,
+        is_marked=q.get("題號") in state.marked,
+        is_multiple=True if q.get("題別") == "複" else False,
+    )
 
 
 @app.route("/")
@@ -65,7 +192,10 @@ def index():
     # 傳遞所有題號給前端，以便生成下拉選單
     all_question_ids = [q.get("題號") for q in questions]
     return render_template(
-        "index.html", all_question_ids=all_question_ids, total_questions=len(questions)
+        "index.html",
+        all_question_ids=all_question_ids,
+        total_questions=len(questions),
+        ai_sse=True,
     )
 
 
@@ -82,18 +212,21 @@ def test():
 
 @app.route("/review")
 def review():
+    wrong_questions = questions_by_ids(current_question_ids("wrong"))
     with open("wrong_questions.json", "w", encoding="utf-8") as f:
         json.dump(wrong_questions, f, ensure_ascii=False, indent=2)
-    return render_template("review.html", wrong_questions=wrong_questions)
+    return render_template(
+        "review.html", wrong_questions=wrong_questions, ai_batch=True
+    )
 
 
 @app.route("/save_question")
 def save_question():
     type = request.args.get("type", "")
     if type == "wrong":
-        questions_to_save = wrong_questions
+        questions_to_save = questions_by_ids(current_question_ids("wrong"))
     elif type == "marked":
-        questions_to_save = marked_questions
+        questions_to_save = questions_by_ids(current_question_ids("marked"))
     else:
         return "無效的類型", 400
     data = json.dumps(questions_to_save, ensure_ascii=False, indent=2)
@@ -109,8 +242,6 @@ def save_question():
     default_filename = (
         "+".join({remove_suffixs(q) for q in questions_to_save}) + "_" + type + ".json"
     )
-    from urllib.parse import quote
-
     # 使用 RFC 5987 編碼來處理非 ASCII 字元
     return Response(
         file_obj,
@@ -123,19 +254,52 @@ def save_question():
 
 @app.route("/review_marked")
 def review_marked():
-    return render_template("review_marked.html", marked_questions=marked_questions)
+    return render_template(
+        "review_marked.html",
+        marked_questions=questions_by_ids(current_question_ids("marked")),
+    )
 
 
 @app.route("/review_ai")
 def review_ai():
     q_ai = []
+    # 同一題的每種模式（精簡、詳細、公正、單一選項）都列出
+    variants = explanation_cache.variants_all()
     for q in questions:
-        q["ai_explanation"] = ai_explanation_cache.get(q["題號"], "")
-        if q["ai_explanation"] != "":
-            q_ai.append(q)
+        if q["題號"] in variants:
+            q_ai.append(dict(q, ai_variants=variants[q["題號"]]))
     return render_template("review_ai.html", q_ai=q_ai)
 
 
+@app.route("/image/<path:question_id>")
+def question_image(question_id):
+    image_path = question_images.get(question_id)
+    if image_path is None:
+        abort(404)
+    # conditional=True 會加上 ETag / Last-Modified 並處理 304
+    return send_file(
+        image_path, mimetype="image/png", conditional=True, max_age=IMAGE_MAX_AGE
+    )
+
+
+def image_url(question_id, version):
+    """題目圖片的網址；以檔案修改時間作為版本，讓瀏覽器可長期快取。"""
+    return f"/image/{quote(question_id)}?v={version}"
+
+
+@app.route("/ai_rate_stats")
+def ai_rate_stats():
+    return jsonify(rate_limiter.metrics())
+
+
+@app.route("/ai_cache_stats")
+def ai_cache_stats():
+    stats = explanation_cache.stats()
+    if prefetcher is not None:
+        stats["prefetch"] = prefetcher.stats()
+    return jsonify(stats)
+
+
 @app.route("/search")
 def search_page():
     return render_template("search.html")
@@ -143,18 +307,13 @@ def search_page():
 
 @app.route("/save_progress")
 def save_progress():
-    data = {
-        "questions": questions,
-        "answered_questions": list(answered_questions),
-        "wrong_questions": wrong_questions,
-        "marked_questions": marked_questions,
-        "question_index_dict": question_index_dict,
-        "wrong_questions_answer_count": wrong_questions_answer_count,
-        "remaining_questions": remaining_questions,
-        "question_index": question_index,
-    }
+    state = current_state()
+    with state.lock:
+        snapshot = progress_snapshot(state)
     file_obj = io.BytesIO()
-    file_obj.write(json.dumps(data, indent=2).encode("utf-8"))
+    file_obj.write(
+        json.dumps(snapshot, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    )
     file_obj.seek(0)
     # 讓使用者下載檔案
     return Response(
@@ -166,112 +325,110 @@ def save_progress():
 
 @app.route("/get_question")
 def get_question():
-    global question_index, remaining_questions, wrong_questions, wrong_questions_answer_count, prev_question_index
     mode = request.args.get("mode", "random")
     question_id = request.args.get("question_id")
     prev = request.args.get("prev", "false").lower() == "true"
     long = request.args.get("long", "false").lower() == "true"
+    # 目前詳解按鈕的模式，預先生成下一題時使用相同的模式
+    is_detail = request.args.get("detail", "false").lower() == "true"
+    is_honest = request.args.get("honest", "false").lower() == "true"
 
     if not questions:
         return jsonify({"error": "題庫尚未載入"})
 
-    if prev:
-        question_index = max(0, question_index - 2)
-        if long:
-            q = questions[prev_question_index]
-            question_index = prev_question_index
-        else:
-            q = questions[question_index]
-            question_index += 1
-        # 透過題號判斷題目是否已被標記
-        q["is_marked"] = any(
-            marked_q.get("題號") == q.get("題號") for marked_q in marked_questions
-        )
-        q["is_multiple"] = True if q.get("題別") == "複" else False
-
-        return jsonify(q)
-
-    # 處理跳轉到特定題號的請求
-    if question_id:
-        try:
-            if question_id in question_index_dict:
-                question_index = question_index_dict[question_id]
+    state = current_state()
+    with state.lock:
+        if prev:
+            state.question_index = max(0, state.question_index - 2)
+            if long:
+                q = questions[state.prev_question_index]
+                state.question_index = state.prev_question_index
             else:
-                raise KeyError
-
-            q = questions[question_index]
-            # 透過題號判斷題目是否已被標記
-            q["is_marked"] = any(
-                marked_q.get("題號") == q.get("題號") for marked_q in marked_questions
-            )
-            q["is_multiple"] = True if q.get("題別") == "複" else False
-
-            question_index += 1
-            return jsonify(q)
-        except StopIteration:
-            return jsonify({"error": f"找不到題號為 {question_id} 的題目"})
-        except KeyError:
-            return jsonify({"error": f"找不到題號為 {question_id} 的題目"})
-
-    if mode == "wrong" and not wrong_questions:
-        return jsonify({"error": "目前沒有錯題"})
-
-    q = None
-    if mode == "random":
-        if remaining_questions:
-            q = random.choice(remaining_questions)
-            prev_question_index = question_index
-            question_index = questions.index(q)
-    elif mode == "order":
-        if question_index < len(questions):
-            q = questions[question_index]
-            question_index += 1
-        else:
-            question_index = 0
-            q = questions[question_index]
-            question_index += 1
-    elif mode == "wrong":
-        if wrong_questions:
-            # q = random.choice(wrong_questions)
-            q = wrong_questions[0]
-            wrong_questions_answer_count += 1
-            wrong_questions.remove(q)
-            wrong_questions.append(q)
-            if wrong_questions_answer_count >= len(wrong_questions):
-                wrong_questions_answer_count = 0
-                random.shuffle(wrong_questions)
-
-    if q is None:
-        return jsonify({"error": "所有題目都已出完！", "finished": True})
-
-    # 修正：確保所有回傳題目的判斷方式一致
-    q["is_marked"] = any(
-        marked_q.get("題號") == q.get("題號") for marked_q in marked_questions
-    )
-    q["is_multiple"] = True if q.get("題別") == "複" else False
-    return jsonify(q)
+                q = questions[state.question_index]
+                state.question_index += 1
+            return jsonify(question_payload(state, q))
+
+        # 處理跳轉到特定題號的請求
+        if question_id:
+            if question_id not in question_index_dict:
+                return jsonify({"error": f"找不到題號為 {question_id} 的題目"})
+            state.question_index = question_index_dict[question_id]
+            q = questions[state.question_index]
+            state.question_index += 1
+            return jsonify(question_payload(state, q))
+
+        if mode == "wrong" and not state.wrong:
+            return jsonify({"error": "目前沒有錯題"})
+
+        q = None
+        if mode == "random":
+            random_index = state.draw_random_index(random_rng)
+            if random_index is not None:
+                q = questions[random_index]
+                state.prev_question_index = state.question_index
+                state.question_index = random_index
+        elif mode == "order":
+            if state.question_index >= len(questions):
+                state.question_index = 0
+            q = questions[state.question_index]
+            state.question_index += 1
+        elif mode == "wrong":
+            if state.wrong_queue:
+                q = question_by_id(state.next_wrong(random_rng))
+
+        if q is None:
+            return jsonify({"error": "所有題目都已出完！", "finished": True})
+
+        payload = question_payload(state, q)
+        upcoming = next_question(state, mode) if prefetcher is not None else None
+
+    if upcoming is not None:
+        prefetch_explanation(upcoming, is_detail, is_honest)
+    return jsonify(payload)
+
+
+def next_question(state, mode):
+    """依目前狀態預測下一題（呼叫端需持有 state.lock）；隨機模式無法預測，回傳 None。"""
+    if mode == "order":
+        index = state.question_index if state.question_index < len(questions) else 0
+        return questions[index]
+    if mode == "wrong" and state.wrong_queue:
+        return question_by_id(state.wrong_queue[0])
+    return None
+
+
+def prefetch_explanation(q, is_detail=False, is_honest=False):
+    """在背景為 q 生成詳解；已有快取時略過。"""
+    prompt = generate_prompt(q, "", is_detail, is_honest)
+    if explanation_cache.has(q["題號"], prompt):
+        return
+    prefetcher.submit(q["題號"], prompt, explanation_variant("", is_detail, is_honest))
 
 
 @app.route("/submit_answer", methods=["POST"])
 def submit_answer():
-    global remaining_questions
     data = request.json
     q = data["question"]
     answer = data["answer"].strip().upper()
 
     correct = q.get("答案", "").strip().upper()
     is_correct = answer == correct
-
-    if not is_correct:
-        if q not in wrong_questions:
-            wrong_questions.append(q)
-            # open a file to save every wrong question as history
-            with open("wrong_questions_history.json", "a", encoding="utf-8") as f:
-                f.write(json.dumps(q, ensure_ascii=False, indent=2))
-
-    answered_questions.add(q.get("題號"))
-    if questions[question_index_dict[q.get("題號")]] in remaining_questions:
-        remaining_questions.remove(questions[question_index_dict[q.get("題號")]])
+    question_id = q.get("題號")
+    index = question_index_dict.get(question_id)
+
+    state = current_state()
+    with state.lock:
+        if not is_correct and question_by_id(question_id) is not None:
+            state.add_wrong(question_id)
+        # 已作答的題目在隨機模式抽到時會被略過，不需從列表中移除
+        if index is not None:
+            state.mark_answered(index)
+        answered_count = state.answered_count
+        total_wrong = len(state.wrong)
+        answered_wrong = state.wrong_answer_count
+
+    # 作答紀錄交給背景執行緒寫入，不在請求中等待磁碟 I/O
+    answer_journal.record(id=question_id, answer=answer, correct=is_correct)
 
     return jsonify(
         {
@@ -279,9 +436,9 @@ def submit_answer():
             "right_answer": correct,
             # "answered_count": "{}/{}".format(len(answered_questions), len(questions)) if questions else len(answered_questions),
             "total_questions": len(questions),
-            "answered_count_total": len(answered_questions),
-            "total_wrong": len(wrong_questions),
-            "answered_wrong": wrong_questions_answer_count,
+            "answered_count_total": answered_count,
+            "total_wrong": total_wrong,
+            "answered_wrong": answered_wrong,
         }
     )
 
@@ -290,31 +447,161 @@ def submit_answer():
 def mark_question():
     data = request.json
     q = data["question"]
-    # 儲存題號，而不是整個題目物件
-    if q.get("題號") not in [mq.get("題號") for mq in marked_questions]:
-        marked_questions.append(q)
-        return jsonify({"status": "marked"})
-    else:
+    state = current_state()
+    with state.lock:
+        if state.toggle_marked(q.get("題號")):
+            return jsonify({"status": "marked"})
         # 如果已經標記過，則取消標記
-        marked_questions[:] = [
-            mq for mq in marked_questions if mq.get("題號") != q.get("題號")
-        ]
         return jsonify({"status": "unmarked"})
 
 
 @app.route("/reset_questions", methods=["POST"])
 def reset_questions():
-    global remaining_questions, question_index, answered_questions
-    remaining_questions = list(questions)
-    question_index = 0
-    answered_questions.clear()
+    state = current_state()
+    with state.lock:
+        state.reset()
     return jsonify({"status": "reset"})
 
 
+def ids_digest(question_list):
+    """題庫的識別雜湊：依序串接所有題號後取 SHA-1。"""
+    return hashlib.sha1(
+        "\n".join(q["題號"] for q in question_list).encode("utf-8")
+    ).hexdigest()
+
+
+def pack_indices(indices, size):
+    """將題目索引集合轉成 bitset，並以 base64 字串表示。"""
+    bits = bytearray((size + 7) // 8)
+    for i in indices:
+        bits[i >> 3] |= 1 << (i & 7)
+    return base64.b64encode(bits).decode("ascii")
+
+
+def unpack_indices(encoded, size):
+    bits = base64.b64decode(encoded)
+    return [i for i in range(size) if bits[i >> 3] & (1 << (i & 7))]
+
+
+def pack_order(order):
+    """將隨機排列 (array "I") 以 little-endian 位元組存成 base64 字串。"""
+    order = array("I", order)
+    if sys.byteorder == "big":
+        order.byteswap()
+    return base64.b64encode(order.tobytes()).decode("ascii")
+
+
+def unpack_order(encoded):
+    order = array("I")
+    order.frombytes(base64.b64decode(encoded))
+    if sys.byteorder == "big":
+        order.byteswap()
+    return order
+
+
+def progress_snapshot(state):
+    """產生精簡的進度資料：只記錄題庫識別與題號清單 / bitset，不含題目內容（呼叫端需持有 state.lock）。
+
+    題目來自舊格式進度檔案（沒有可重新載入的題庫檔案）時，改存舊格式，題目內容一併保存。
+    """
+    if not loaded_banks and questions:
+        return legacy_progress_snapshot(state)
+    detached = [
+        detached_questions[question_id]
+        for question_id in {**state.wrong, **state.marked}
+        if question_id in detached_questions
+    ]
+    return {
+        "version": PROGRESS_VERSION,
+        "banks": loaded_banks,
+        "answered": pack_indices(state.answered_indices(), len(questions)),
+        "wrong": list(state.wrong),
+        "wrong_queue": list(state.wrong_queue),
+        "marked": list(state.marked),
+        # 不在已載入題庫中的錯題/標記題（例如由 --wrong 載入）才保存完整內容
+        "detached": detached,
+        "random_order": pack_order(state.random_order or array("I")),
+        "random_cursor": state.random_cursor,
+        "question_index": state.question_index,
+        "prev_question_index": state.prev_question_index,
+        "wrong_questions_answer_count": state.wrong_answer_count,
+    }
+
+
+def legacy_progress_snapshot(state):
+    """舊格式的進度資料：題目與錯題、標記題的內容直接存在檔案中。"""
+    return {
+        "questions": questions,
+        "question_images": {k: str(v) for k, v in question_images.items()},
+        "answered_questions": [questions[i]["題號"] for i in state.answered_indices()],
+        "wrong_questions": [question_by_id(question_id) for question_id in state.wrong],
+        "marked_questions": [question_by_id(question_id) for question_id in state.marked],
+        "wrong_questions_answer_count": state.wrong_answer_count,
+        "random_order": list(state.random_order) if state.random_order else None,
+        "random_cursor": state.random_cursor,
+        "question_index": state.question_index,
+    }
+
+
+def restore_progress(state, data):
+    """將精簡進度套用到使用者狀態（需先以進度中的題庫路徑呼叫 load_questions）。"""
+    saved_digests = [bank["ids_sha1"] for bank in data.get("banks", [])]
+    if saved_digests == [bank["ids_sha1"] for bank in loaded_banks]:
+        for i in unpack_indices(data["answered"], len(questions)):
+            state.mark_answered(i)
+        order = unpack_order(data["random_order"])
+        if len(order) == len(questions):
+            state.random_order = order
+            state.random_cursor = data.get("random_cursor", 0)
+        state.question_index = data.get("question_index", 0)
+        state.prev_question_index = data.get("prev_question_index", 0)
+    else:
+        print("⚠️ 題庫內容與進度檔案不同，已答題目與出題順序將重新開始")
+
+    remember_questions(data.get("detached", []))
+    state.set_wrong(
+        question_id
+        for question_id in data.get("wrong", [])
+        if question_by_id(question_id) is not None
+    )
+    saved_queue = [
+        question_id
+        for question_id in data.get("wrong_queue", [])
+        if question_id in state.wrong
+    ]
+    if len(saved_queue) == len(state.wrong):
+        state.wrong_queue = deque(saved_queue)
+    state.marked = dict.fromkeys(
+        question_id
+        for question_id in data.get("marked", [])
+        if question_by_id(question_id) is not None
+    )
+    state.wrong_answer_count = data.get("wrong_questions_answer_count", 0)
+
+
+def remember_questions(question_list):
+    """記錄不在題庫中的題目，回傳所有題目的題號。"""
+    for q in question_list:
+        if q["題號"] not in question_index_dict:
+            detached_questions[q["題號"]] = q
+    return [q["題號"] for q in question_list]
+
+
+def reset_quiz_state():
+    """題庫變動後，重新建立初始狀態並清除所有使用者的作答狀態。"""
+    global default_state
+    default_state = QuizState(len(questions))
+    quiz_sessions.reset_all(default_state)
+
+
+def question_prompt_part(question):
+    return f"題目：{question['題目']}\n選項：{' '.join(question['選項'])}\n答案：{question['答案']}"
+
+
 def generate_prompt(
     question, choice, is_detail=False, is_honest=False, is_choiceOnly=False
 ):
-    question_part = f"題目：{question['題目']}\n選項：{' '.join(question['選項'])}\n答案：{question['答案']}"
+    question_part = question_prompt_part(question)
     prompt = f"請以繁體中文，針對以下問題，生成精簡的解釋：\n\n{question_part}"
     if is_detail:
         prompt = f"請以繁體中文，針對以下問題，生成 1 分鐘內可以閱讀完的詳解，包含關鍵概念和每個選項解釋，文字簡明，重點清楚：\n\n{question_part}"
@@ -334,11 +621,259 @@ def generate_prompt(
     return prompt
 
 
+def batch_instructions(is_detail=False, is_honest=False):
+    """批次生成時各題共用的說明，內容與 generate_prompt 的單題 prompt 相同。"""
+    if is_detail:
+        instructions = "請以繁體中文，針對以下每一題，分別生成 1 分鐘內可以閱讀完的詳解，包含關鍵概念和每個選項解釋，文字簡明，重點清楚。"
+    else:
+        instructions = "請以繁體中文，針對以下每一題，分別生成精簡的解釋。"
+    instructions += "\n簡要說明答題關鍵知識，若需要分類、分級、分型等知識也請簡要列出完整分級。"
+    if is_honest:
+        instructions += "\n若答案不合理則要公正的指出。"
+    return instructions
+
+
+def explanation_variant(choice, is_detail=False, is_honest=False, is_choiceOnly=False):
+    """詳解模式的名稱，與 generate_prompt 的參數對應，供快取與總覽頁區分同一題的不同詳解。"""
+    if is_choiceOnly:
+        variant = f"選項說明：{choice}"
+    else:
+        variant = "詳細" if is_detail else "精簡"
+    if is_honest:
+        variant += "（公正）"
+    return variant
+
+
+def generate_explanation(flight, question_id, prompt, variant="", user=""):
+    """呼叫 Gemini 串流生成詳解，將片段發佈到 flight，完成後寫入快取。"""
+    current_tokens = 0
+    error = None
+    response = rate_limiter.stream(
+        lambda: client.models.generate_content_stream(model=MODEL, contents=prompt),
+        user,
+    )
+    try:
+        for chunk in response:
+            if flight.cancelled:
+                # 讀取端皆已離線：停止讀取並關閉上游串流，不再花費 token
+                error = RuntimeError(CANCELLED_MESSAGE)
+                break
+            if chunk.text:
+                flight.publish(chunk.text)
+            if chunk.usage_metadata and chunk.usage_metadata.total_token_count:
+                current_tokens = chunk.usage_metadata.total_token_count
+    except Exception as e:
+        error = e
+    finally:
+        close = getattr(response, "close", None)
+        if close is not None:
+            close()
+    finish_explanation(flight, question_id, prompt, current_tokens, variant, error)
+
+
+async def generate_explanation_async(
+    flight, question_id, prompt, variant="", user=""
+):
+    """generate_explanation 的非同步版本，使用 client.aio 在共用 event loop 上執行。"""
+    current_tokens = 0
+    response = rate_limiter.astream(
+        lambda: client.aio.models.generate_content_stream(
+            model=MODEL, contents=prompt
+        ),
+        user,
+    )
+    try:
+        async for chunk in response:
+            if chunk.text:
+                flight.publish(chunk.text)
+            if chunk.usage_metadata and chunk.usage_metadata.total_token_count:
+                current_tokens = chunk.usage_metadata.total_token_count
+    except asyncio.CancelledError:
+        # 讀取端皆已離線而被取消：仍需記錄已使用的 token
+        error = RuntimeError(CANCELLED_MESSAGE)
+        finish_explanation(flight, question_id, prompt, current_tokens, variant, error)
+        raise
+    except Exception as e:
+        finish_explanation(flight, question_id, prompt, current_tokens, variant, e)
+        return
+    finish_explanation(flight, question_id, prompt, current_tokens, variant)
+
+
+def finish_explanation(
+    flight, question_id, prompt, current_tokens, variant="", error=None
+):
+    """累計 token 數（包含中斷前已使用的部分），完整的詳解才寫入快取，並通知等待中的請求。"""
+    global total_tokens_used
+    with tokens_lock:
+        total_tokens_used += current_tokens
+    if error is not None:
+        flight.fail(error, current_tokens)
+        return
+    explanation = "".join(flight.chunks)
+    if explanation:
+        explanation_cache.put(
+            question_id, prompt, explanation, current_tokens, variant=variant
+        )
+    flight.finish(current_tokens)
+
+
+def start_explanation(question_id, prompt, variant="", user=""):
+    """開始（或附加到進行中的）詳解生成，回傳 (flight, started)。
+
+    user 為限流排隊時區分使用者的鍵；預先生成等背景工作使用空字串，共用同一個順位。
+    """
+    if ai_runner is not None:
+        return ai_flights.run(
+            (question_id, prompt),
+            lambda flight: generate_explanation_async(
+                flight, question_id, prompt, variant, user
+            ),
+            runner=ai_runner,
+        )
+    return ai_flights.run(
+        (question_id, prompt),
+        lambda flight: generate_explanation(flight, question_id, prompt, variant, user),
+    )
+
+
+def generate_explanation_batch(batch, is_detail=False, is_honest=False, user=""):
+    """以單一請求生成 batch（[(題目, 單題 prompt)]）中每一題的詳解，各自以單題 prompt 寫入快取。
+
+    回傳 ({題號: 詳解}, 使用的 token 數, {題號: 錯誤})。批次回應無法解析或缺少的題目改為逐題生成。
+    """
+    global total_tokens_used
+    variant = explanation_variant("", is_detail, is_honest)
+    prompts = {q["題號"]: prompt for q, prompt in batch}
+    explanations = {}
+    tokens = 0
+    if len(batch) > 1:
+        batch_prompt = build_batch_prompt(
+            batch_instructions(is_detail, is_honest),
+            [(q["題號"], question_prompt_part(q)) for q, _ in batch],
+        )
+        try:
+            response = rate_limiter.call(
+                lambda: client.models.generate_content(
+                    model=MODEL, contents=batch_prompt, config=GENERATION_CONFIG
+                ),
+                user,
+            )
+            usage = response.usage_metadata
+            tokens = (usage.total_token_count or 0) if usage else 0
+            with tokens_lock:
+                total_tokens_used += tokens
+            explanations = parse_batch_response(response.text, prompts)
+        except Exception as e:
+            print(f"⚠️ 批次生成失敗，改為逐題生成：{e}")
+        shares = split_tokens(tokens, explanations)
+        for question_id, explanation in explanations.items():
+            explanation_cache.put(
+                question_id,
+                prompts[question_id],
+                explanation,
+                shares[question_id],
+                variant=variant,
+            )
+
+    # 批次未涵蓋的題目逐題生成，與一般請求共用同一個生成過程
+    flights = [
+        (question_id, *start_explanation(question_id, prompt, variant, user))
+        for question_id, prompt in prompts.items()
+        if question_id not in explanations
+    ]
+    errors = {}
+    for question_id, flight, started in flights:
+        explanation = flight.wait()
+        if flight.error is not None:
+            errors[question_id] = flight.error
+            continue
+        explanations[question_id] = explanation
+        if started:
+            tokens += flight.tokens
+    return explanations, tokens, errors
+
+
+def rate_limit_user():
+    """目前請求在限流佇列中的使用者鍵：session cookie，沒有時使用來源 IP。"""
+    return request.cookies.get(QuizSessions.COOKIE_NAME) or request.remote_addr or ""
+
+
+def prefill_ai_explanations(
+    workers=4, rpm=60, token_budget=None, is_detail=False, batch_size=1
+):
+    """預先為已載入的題目生成 AI 詳解並寫入快取。
+
+    已在快取中的題目會略過，因此中斷後重新執行即可從未完成的題目繼續。
+    rpm 限制每分鐘發出的請求數；累積 token 達到 token_budget 後停止送出新請求。
+    batch_size 大於 1 時每個請求包含多題（見 generate_explanation_batch）。
+    """
+    pending = []
+    for q in questions:
+        prompt = generate_prompt(q, "", is_detail)
+        if not explanation_cache.has(q["題號"], prompt):
+            pending.append((q, prompt))
+    batch_size = max(1, batch_size)
+    batches = [
+        pending[i : i + batch_size] for i in range(0, len(pending), batch_size)
+    ]
+    print(f"🤖 共 {len(questions)} 題，已快取 {len(questions) - len(pending)} 題")
+    if not pending:
+        return
+
+    interval = 60 / rpm if rpm else 0
+    pace_lock = threading.Lock()
+    next_slot = time.monotonic()
+    spent_tokens = 0
+    failures = []
+
+    def wait_for_slot():
+        nonlocal next_slot
+        with pace_lock:
+            now = time.monotonic()
+            slot = max(now, next_slot)
+            next_slot = slot + interval
+        time.sleep(slot - now)
+
+    def work(batch):
+        if token_budget is not None and spent_tokens >= token_budget:
+            return None
+        wait_for_slot()
+        return generate_explanation_batch(batch, is_detail)
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        with tqdm(total=len(pending), desc="AI 詳解", unit="題") as progress:
+            futures = {executor.submit(work, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                batch = futures[future]
+                try:
+                    result = future.result()
+                    if result is not None:
+                        _, tokens, errors = result
+                        spent_tokens += tokens
+                        for question_id, error in errors.items():
+                            failures.append(question_id)
+                            tqdm.write(f"❌ 題號 {question_id} 生成失敗：{error}")
+                except Exception as e:
+                    for q, _ in batch:
+                        failures.append(q["題號"])
+                    tqdm.write(f"❌ 題號 {batch[0][0]['題號']} 等 {len(batch)} 題生成失敗：{e}")
+                progress.set_postfix(tokens=spent_tokens, failed=len(failures))
+                progress.update(len(batch))
+    except KeyboardInterrupt:
+        print("⏹️ 已中斷，下次執行會從尚未快取的題目繼續")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if token_budget is not None and spent_tokens >= token_budget:
+        print(f"⚠️ 已達 token 上限 {token_budget}，其餘題目未送出")
+    print(f"✅ 預先生成完成，使用 token：{spent_tokens}，失敗：{len(failures)} 題")
+
+
 @app.route("/get_ai_explanation", methods=["POST"])
 def get_ai_explanation():
     if ai_key == False:
         return jsonify({"error": "未設定 API Key，無法使用 AI 詳解"}), 400
-    global total_tokens_used
     is_detail = request.args.get("detail", "false").lower() == "true"
     is_honest = request.args.get("honest", "false").lower() == "true"
     is_choiceOnly = request.args.get("choiceOnly", "false").lower() == "true"
@@ -365,61 +900,44 @@ def get_ai_explanation():
 
     # 先設定prompt
     prompt = generate_prompt(question, choice, is_detail, is_honest, is_choiceOnly)
+    variant = explanation_variant(choice, is_detail, is_honest, is_choiceOnly)
 
-    # 檢查快取中是否有詳解，有的話直接回傳，如果prompt不一樣也繼續
-    if question_id in ai_explanation_cache and prompt_cache[question_id] == prompt:
-        explanation = ai_explanation_cache[question_id]
-        if explanation is not None:
-            print(f"✅ 題號 {question_id} 的詳解已從快取中取得。")
-            return jsonify(
-                {
-                    "explanation": explanation,
-                    "current_tokens": 0,  # 從快取中取得，不計算 token 數
-                    "total_tokens": total_tokens_used,
-                }
-            )
-
-    try:
-        # response = model.generate_content(prompt)
-        response = client.models.generate_content(
-            model=MODEL,
-            contents=prompt,
-        )
-        # 移除這行程式碼，讓 AI 回傳的換行和格式得以保留
-        explanation = response.text
-
-        # 步驟 3: 將新的詳解儲存到快取中
-        ai_explanation_cache[question_id] = explanation
-        prompt_cache[question_id] = prompt
-
-        # 計算本次請求的總 token 數 (input + output)
-        current_tokens = response.usage_metadata.total_token_count
-
-        # 更新累積 token 數
-        total_tokens_used += current_tokens
-
-        # html = review_ai()
-        # with open("tmp_explanation.html", "w", encoding="utf-8") as f:
-        #     f.write(html)
-
+    # 檢查快取中是否有相同 prompt 的詳解，有的話直接回傳
+    explanation = explanation_cache.get(question_id, prompt)
+    if explanation is not None:
+        print(f"✅ 題號 {question_id} 的詳解已從快取中取得。")
         return jsonify(
             {
                 "explanation": explanation,
-                "current_tokens": current_tokens,
+                "current_tokens": 0,  # 從快取中取得，不計算 token 數
                 "total_tokens": total_tokens_used,
             }
         )
-    except Exception as e:
-        print(f"Gemini API 呼叫失敗: {e}")
+
+    # 相同題目與 prompt 正在生成時，直接等待同一個生成結果
+    flight, started = start_explanation(question_id, prompt, variant, rate_limit_user())
+    explanation = flight.wait()
+    if isinstance(flight.error, RateLimitTimeout):
+        return jsonify({"error": str(flight.error)}), 429
+    if flight.error is not None:
+        print(f"Gemini API 呼叫失敗: {flight.error}")
         return jsonify({"error": "無法取得 AI 詳解，請稍後再試。"}), 500
 
+    return jsonify(
+        {
+            "explanation": explanation,
+            # 附加到他人進行中的生成時不重複計算 token 數
+            "current_tokens": flight.tokens if started else 0,
+            "total_tokens": total_tokens_used,
+        }
+    )
+
 
 # 新增一個用於串流回應的路由
 @app.route("/stream_ai_explanation", methods=["POST"])
 def stream_ai_explanation():
     if ai_key == False:
         return jsonify({"error": "未設定 API Key，無法使用 AI 詳解"}), 400
-    global total_tokens_used
     is_detail = request.args.get("detail", "false").lower() == "true"
     is_honest = request.args.get("honest", "false").lower() == "true"
     is_choiceOnly = request.args.get("choiceOnly", "false").lower() == "true"
@@ -446,73 +964,217 @@ def stream_ai_explanation():
 
     # 先設定prompt
     prompt = generate_prompt(question, choice, is_detail, is_honest, is_choiceOnly)
+    variant = explanation_variant(choice, is_detail, is_honest, is_choiceOnly)
 
-    # 檢查快取中是否有詳解，有的話直接回傳，如果prompt不一樣也繼續
-    if question_id in ai_explanation_cache and prompt_cache[question_id] == prompt:
-        explanation = ai_explanation_cache[question_id]
-        if explanation is not None:
+    # 檢查快取中是否有相同 prompt 的詳解，有的話直接回傳
+    explanation = explanation_cache.get(question_id, prompt)
+    if explanation is not None:
+        print(f"✅ 題號 {question_id} 的詳解已從快取中取得。")
 
-            print(f"✅ 題號 {question_id} 的詳解已從快取中取得。")
-
-            def response():
-                token_info = {
-                    "current_tokens": 0,  # 從快取中取得，不計算 token 數
-                    "total_tokens": total_tokens_used,
-                }
-                yield explanation.encode("utf-8")
-                yield f"<div data-tokens='{json.dumps(token_info)}' style='display:none;'></div>".encode(
-                    "utf-8"
-                )
+        def response():
+            token_info = {
+                "current_tokens": 0,  # 從快取中取得，不計算 token 數
+                "total_tokens": total_tokens_used,
+            }
+            yield explanation.encode("utf-8")
+            yield f"<div data-tokens='{json.dumps(token_info)}' style='display:none;'></div>".encode(
+                "utf-8"
+            )
 
-            return Response(response(), mimetype="text/html")
+        return Response(response(), mimetype="text/html")
 
     # 確保 prompt_tokens 在串流開始前計算一次
     # 因為 prompt tokens 在發送請求時就已確定
     # prompt_tokens = client.models.count_tokens(model=MODEL, contents=prompt).total_tokens
 
-    def generate_stream():
-        global total_tokens_used
-
-        final_current_tokens = 0
-        full_explanation = ""
-        try:
-            response = client.models.generate_content_stream(
-                model=MODEL, contents=prompt
-            )
-            # 呼叫 genai API 並啟用串流
-            for chunk in response:
-                if chunk.text:
-                    yield chunk.text.encode("utf-8")
-                    full_explanation += chunk.text
-                if chunk.usage_metadata:
-                    final_current_tokens = chunk.usage_metadata.total_token_count
-
-            if final_current_tokens > 0:
-                total_tokens_used += final_current_tokens
-                token_info = {
-                    "current_tokens": final_current_tokens,
-                    "total_tokens": total_tokens_used,
-                }
-                ai_explanation_cache[question_id] = full_explanation
-                prompt_cache[question_id] = prompt
+    # 相同題目與 prompt 正在生成時，先重播已產生的片段再接續後面的內容
+    flight, started = start_explanation(question_id, prompt, variant, rate_limit_user())
+    # 限流排隊逾時發生在送出第一個片段之前，等到開始產生內容再回應，才能改回傳 429
+    flight.wait_started()
+    if not flight.chunks and isinstance(flight.error, RateLimitTimeout):
+        return jsonify({"error": str(flight.error)}), 429
 
-            # 將 JSON 資訊傳送給前端
-            yield f"<div data-tokens='{json.dumps(token_info)}' style='display:none;'></div>".encode(
-                "utf-8"
-            )
+    def generate_stream():
+        for chunk in flight.follow():
+            yield chunk.encode("utf-8")
 
-        except Exception as e:
+        if flight.error is not None:
             # 處理可能發生的 API 錯誤
-            error_message = f"無法取得 AI 詳解：{e}"
+            error_message = f"無法取得 AI 詳解：{flight.error}"
             yield f'<p style="color:red;">{error_message}</p>'.encode("utf-8")
+            return
+
+        token_info = {
+            "current_tokens": flight.tokens if started else 0,
+            "total_tokens": total_tokens_used,
+        }
+        # 將 JSON 資訊傳送給前端
+        yield f"<div data-tokens='{json.dumps(token_info)}' style='display:none;'></div>".encode(
+            "utf-8"
+        )
 
     # 這裡回傳 Response 物件，並將生成器函式作為回應內容
     # mimetype 設為 text/html，讓瀏覽器能直接解析 HTML 標籤
     return Response(generate_stream(), mimetype="text/html")
 
 
+# 批次生成錯題（或標記題）中尚未快取的 AI 詳解：在背景執行並立即回傳工作識別碼，
+# 以 GET /batch_ai_explanation/<job_id> 查詢進度，完成後可在 /review_ai 查看
+@app.route("/batch_ai_explanation", methods=["POST"])
+def batch_ai_explanation():
+    if ai_key == False:
+        return jsonify({"error": "未設定 API Key，無法使用 AI 詳解"}), 400
+    is_detail = request.args.get("detail", "false").lower() == "true"
+    is_honest = request.args.get("honest", "false").lower() == "true"
+    type = request.args.get("type", "wrong")
+    if type in ("wrong", "marked"):
+        question_ids = current_question_ids(type)
+    else:
+        return jsonify({"error": "無效的類型"}), 400
+
+    pending = []
+    for q in questions_by_ids(question_ids):
+        prompt = generate_prompt(q, "", is_detail, is_honest)
+        if not explanation_cache.has(q["題號"], prompt):
+            pending.append((q, prompt))
+
+    size = max(1, ai_batch_size)
+    batches = [pending[i : i + size] for i in range(0, len(pending), size)]
+    job = BatchJob(len(question_ids), len(batches), cached=len(question_ids) - len(pending))
+    job_id = secrets.token_urlsafe(8)
+    with batch_jobs_lock:
+        batch_jobs[job_id] = job
+        while len(batch_jobs) > BATCH_JOBS_KEPT:
+            batch_jobs.popitem(last=False)
+
+    user = rate_limit_user()
+
+    def work(batch):
+        try:
+            explanations, tokens, errors = generate_explanation_batch(
+                batch, is_detail, is_honest, user
+            )
+        except Exception as e:
+            print(f"Gemini API 呼叫失敗: {e}")
+            job.record_failure([q["題號"] for q, _ in batch])
+            return
+        for error in errors.values():
+            print(f"Gemini API 呼叫失敗: {error}")
+        job.record(explanations, tokens, errors)
+
+    for batch in batches:
+        batch_executor.submit(work, batch)
+    return jsonify(dict(job.snapshot(), job_id=job_id)), 202
+
+
+@app.route("/batch_ai_explanation/<job_id>")
+def batch_ai_progress(job_id):
+    with batch_jobs_lock:
+        job = batch_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "找不到批次工作"}), 404
+    return jsonify(dict(job.snapshot(), total_tokens=total_tokens_used))
+
+
+def sse_event(event, data, event_id=None):
+    """組成一筆 Server-Sent Events 訊息；data 以 JSON 編碼，避免換行破壞格式。"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+# 以 SSE (text/event-stream) 串流 AI 詳解
+# 事件：cached、delta、usage、error、done、reset；事件 id 為「生成識別碼:已送出的字元數」，
+# 斷線重連時瀏覽器會帶上 Last-Event-ID：仍是同一個生成（或快取內容）就從該位置繼續傳送，
+# 否則（原本的生成已取消或失敗，改由新的生成產生）送出 reset 事件，從頭重新傳送
+@app.route("/sse_ai_explanation")
+def sse_ai_explanation():
+    if ai_key == False:
+        return jsonify({"error": "未設定 API Key，無法使用 AI 詳解"}), 400
+    is_detail = request.args.get("detail", "false").lower() == "true"
+    is_honest = request.args.get("honest", "false").lower() == "true"
+    is_choiceOnly = request.args.get("choiceOnly", "false").lower() == "true"
+    choice = request.args.get("choice", "")
+    question_id = request.args.get("question_id")
+
+    # 包含不在題庫中的錯題/標記題（--wrong 或進度檔案中的 detached）
+    question = question_by_id(question_id)
+    if question is None:
+        return jsonify({"error": f"找不到題號為 {question_id} 的題目"}), 404
+
+    last_event_id = request.headers.get("Last-Event-ID", request.args.get("last_id", ""))
+    last_token, _, last_offset = last_event_id.rpartition(":")
+    try:
+        offset = max(0, int(last_offset))
+    except ValueError:
+        offset = 0
+
+    prompt = generate_prompt(question, choice, is_detail, is_honest, is_choiceOnly)
+    variant = explanation_variant(choice, is_detail, is_honest, is_choiceOnly)
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    explanation = explanation_cache.get(question_id, prompt)
+    if explanation is not None:
+        print(f"✅ 題號 {question_id} 的詳解已從快取中取得。")
+
+        # 快取內容固定，以內容雜湊作為識別碼
+        token = hashlib.sha1(explanation.encode("utf-8")).hexdigest()[:8]
+
+        def cached_events():
+            start = offset if last_token == token else 0
+            if start != offset:
+                yield sse_event("reset", {}, f"{token}:0")
+            token_info = {"current_tokens": 0, "total_tokens": total_tokens_used}
+            yield sse_event("cached", token_info)
+            if start < len(explanation):
+                yield sse_event(
+                    "delta", {"text": explanation[start:]}, f"{token}:{len(explanation)}"
+                )
+            yield sse_event("usage", token_info)
+            yield sse_event("done", {}, f"{token}:{len(explanation)}")
+
+        return Response(cached_events(), mimetype="text/event-stream", headers=headers)
+
+    flight, started = start_explanation(question_id, prompt, variant, rate_limit_user())
+
+    def events():
+        start = offset if last_token == flight.id else 0
+        if start != offset:
+            # 用戶端已收到的是另一個生成的內容，請用戶端清除後從頭接收
+            yield sse_event("reset", {}, f"{flight.id}:0")
+        position = 0
+        for chunk in flight.follow():
+            end = position + len(chunk)
+            if end > start:
+                # 重連時略過用戶端已收到的部分
+                yield sse_event(
+                    "delta", {"text": chunk[max(0, start - position) :]}, f"{flight.id}:{end}"
+                )
+            position = end
+
+        if isinstance(flight.error, RateLimitTimeout):
+            # SSE 已送出 200，改在 error 事件中帶上 429 與限流器的說明
+            yield sse_event("error", {"error": str(flight.error), "status": 429})
+            return
+        if flight.error is not None:
+            yield sse_event("error", {"error": f"無法取得 AI 詳解：{flight.error}"})
+            return
+
+        token_info = {
+            "current_tokens": flight.tokens if started else 0,
+            "total_tokens": total_tokens_used,
+        }
+        yield sse_event("usage", token_info)
+        yield sse_event("done", {}, f"{flight.id}:{position}")
+
+    return Response(events(), mimetype="text/event-stream", headers=headers)
+
+
 def load_questions(json_paths):
-    global questions, remaining_questions, question_index_dict
+    global questions, question_index_dict, loaded_banks
     all_question_files = []
 
     for path_str in json_paths:
@@ -554,66 +1216,54 @@ def load_questions(json_paths):
             all_question_files.append(p)
 
     all_questions = []
-    for file_path in all_question_files:
-        image_folder = file_path.parent / (file_path.stem + "_images")
-        if image_folder.exists():
-            # 讀入圖片檔案
-            image_files = list(image_folder.glob("*.png"))
-
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, list):
-                    cleaned_questions = []
-                    for q in data:
-                        if "題目" in q:
-                            q["題目"] = (
-                                q["題目"]
-                                .replace("\r\n", " ")
-                                .replace("\n", " ")
-                                .strip()
-                            )
-                        if "選項" in q and isinstance(q["選項"], list):
-                            q["選項"] = [
-                                opt.replace("\r\n", " ").replace("\n", " ").strip()
-                                for opt in q["選項"]
-                            ]
-                        match = re.match(r"^(.*?)(?:_\d+)$", q["題號"])
-                        question_stem = "預設"
-                        if match:
-                            question_stem = match.group(1)
-                        if "題號" in q and question_stem not in f"{file_path.stem}":
-                            q["題號"] = f"{file_path.stem}_{q.get('題號')}"
-                            # 如果圖片資料夾中有與題號相同的圖片，則加入題目中
-                            if image_folder.exists():
-                                for image_file in image_files:
-                                    if image_file.stem == q["題號"]:
-                                        print(
-                                            f"　 🖼️ 找到題號 {q['題號']} 的圖片：{(file_path.stem + '_images')}/{image_file.name}"
-                                        )
-                                        # 存入base64編碼的圖片
-                                        with open(image_file, "rb") as img_f:
-                                            img_data = img_f.read()
-                                            img_base64 = (
-                                                "data:image/png;base64,"
-                                                + base64.b64encode(img_data).decode(
-                                                    "utf-8"
-                                                )
-                                            )
-                                            q["圖片"] = img_base64
-                        cleaned_questions.append(q)
-                    all_questions.extend(cleaned_questions)
-                    print(f"✅ 載入檔案：{file_path}，題數：{len(cleaned_questions)}")
-                else:
-                    print(f"⚠️ {file_path} 格式錯誤，非陣列，略過")
-        except json.JSONDecodeError:
+    all_images = {}
+    all_indexes = []
+    loaded_banks = []
+    load_start = time.perf_counter()
+    results = question_bank.load_question_files(
+        all_question_files, use_cache=not args.no_cache, workers=args.workers
+    )
+    for result in results:
+        file_path, bank, error = result["path"], result["bank"], result["error"]
+        if isinstance(error, json.JSONDecodeError):
             print(f"⚠️ {file_path} 無法解析為 JSON，略過")
-        except Exception as e:
-            print(f"❌ 處理檔案 {file_path} 時發生錯誤：{e}")
+            continue
+        elif isinstance(error, ValueError):
+            print(f"⚠️ {file_path} 格式錯誤，非陣列，略過")
+            continue
+        elif error is not None:
+            print(f"❌ 處理檔案 {file_path} 時發生錯誤：{error}")
+            continue
+        all_indexes.append((len(all_questions), SearchIndex.from_data(bank["search"])))
+        all_questions.extend(bank["questions"])
+        all_images.update(bank["images"])
+        loaded_banks.append(
+            {
+                "path": str(Path(file_path).resolve()),
+                "count": len(bank["questions"]),
+                "ids_sha1": ids_digest(bank["questions"]),
+            }
+        )
+        source = "（快取）" if result["from_cache"] else ""
+        print(
+            f"✅ 載入檔案：{file_path}{source}，題數：{len(bank['questions'])}"
+            f"，耗時 {result['seconds']:.3f} 秒"
+        )
+    print(
+        f"⏱️ 載入 {len(results)} 個題庫檔案，共 {time.perf_counter() - load_start:.3f} 秒"
+    )
 
     questions = all_questions
-    remaining_questions = list(questions)
     question_index_dict = {q["題號"]: i for i, q in enumerate(questions)}
+    reset_quiz_state()
+
+    # 圖片只存網址，圖片由 /image/<題號> 提供
+    for question_id, (image_path, version) in all_images.items():
+        question_images[question_id] = Path(image_path)
+        questions[question_index_dict[question_id]]["圖片"] = image_url(
+            question_id, version
+        )
+    build_search_index(all_indexes)
 
     # 自動開啟網頁
     if args.open:
@@ -622,6 +1272,29 @@ def load_questions(json_paths):
         webbrowser.open(f"http://{args.host}:{args.port}")
 
 
+def build_search_index(indexes=None):
+    """準備搜尋資料；indexes 為各題庫的 (起始位置, SearchIndex)，未提供時（例如舊格式進度檔案）直接建立。"""
+    global search_texts, search_indexes
+    search_texts = [search_text(q) for q in questions]
+    if indexes is None:
+        indexes = [(0, SearchIndex.build(search_texts))]
+    search_indexes = indexes
+
+
+def search_candidates(keyword):
+    """回傳可能包含關鍵字的題目索引（已排序），之後仍需用正規式確認。
+
+    單一字元的關鍵字沒有可用的片段，回傳所有題目。
+    """
+    grams = keyword_grams(keyword)
+    if not grams:
+        return range(len(questions))
+    candidates = []
+    for start, index in search_indexes:
+        candidates.extend(start + i for i in index.candidates(grams))
+    return candidates
+
+
 @app.route("/search_questions")
 def search_questions():
     keyword = request.args.get("keyword", "").strip()
@@ -635,18 +1308,20 @@ def search_questions():
         # 移除標記，將剩下的字串視為 regular expression
         regex_pattern = keyword[2:]
         pattern = re.compile(regex_pattern, re.IGNORECASE)
+        # 正規式無法使用索引，逐題掃描
+        candidates = range(len(questions))
     else:
         # 否則，視為純文字，進行轉義
         pattern = re.compile(re.escape(keyword), re.IGNORECASE)
+        candidates = search_candidates(keyword)
 
-    for q in questions:
-        id = q.get("題號", "")
+    for i in candidates:
+        q = questions[i]
         text = q.get("題目", "")
         opts = q.get("選項", [])
         ans = q.get("答案", "")
         # 題目 + 選項 全部檢查
-        combined = id + " " + text + " " + " ".join(opts) + " 答案:" + ans
-        if pattern.search(combined):
+        if pattern.search(search_texts[i]):
             highlighted_question = pattern.sub(
                 lambda m: f"<mark>{m.group(0)}</mark>", text
             )
@@ -679,25 +1354,172 @@ if __name__ == "__main__":
     parser.add_argument("--wrong", "-w", type=str, help="載入錯題檔案")
     parser.add_argument("--save", "-s", type=str, help="載入進度檔案")
     parser.add_argument("--open", "-o", action="store_true", help="自動開啟網頁")
+    parser.add_argument(
+        "--no-cache", action="store_true", help="不使用題庫編譯快取，重新解析 JSON"
+    )
+    parser.add_argument(
+        "--history",
+        default="answer_history.jsonl",
+        help="作答紀錄檔案（JSON Lines，每行一筆：題號、作答、是否正確、時間）",
+    )
+    parser.add_argument(
+        "--ai-cache",
+        default="ai_explanation_cache.sqlite3",
+        help="AI 詳解快取檔案（SQLite）",
+    )
+    parser.add_argument(
+        "--ai-cache-max", default=5000, type=int, help="AI 詳解快取最多保留筆數"
+    )
+    parser.add_argument(
+        "--ai-cache-days", default=None, type=float, help="AI 詳解快取保留天數"
+    )
+    parser.add_argument(
+        "--ai-cache-memory",
+        default=256,
+        type=int,
+        help="AI 詳解在記憶體中保留的筆數（LRU），0 表示只使用 SQLite",
+    )
+    parser.add_argument(
+        "--ai-disconnect",
+        choices=["finish", "cancel"],
+        default="finish",
+        help="瀏覽器中途離線時的處理方式：finish 在背景完成生成並寫入快取；cancel 立即停止上游請求以節省 token",
+    )
+    parser.add_argument(
+        "--async-ai",
+        action="store_true",
+        help="以 asyncio 執行 Gemini 串流，所有串流共用一個 event loop 執行緒",
+    )
+    parser.add_argument(
+        "--prefill-ai",
+        action="store_true",
+        help="預先為載入的題目生成 AI 詳解並寫入快取，完成後結束",
+    )
+    parser.add_argument(
+        "--prefill-workers", default=4, type=int, help="預先生成時同時進行的請求數"
+    )
+    parser.add_argument(
+        "--prefill-rpm", default=60, type=int, help="預先生成時每分鐘最多請求數"
+    )
+    parser.add_argument(
+        "--prefill-token-budget", default=None, type=int, help="預先生成的 token 上限"
+    )
+    parser.add_argument(
+        "--prefill-detail", action="store_true", help="預先生成詳細版（detail）詳解"
+    )
+    parser.add_argument(
+        "--ai-batch-size",
+        default=5,
+        type=int,
+        help="批次生成 AI 詳解（--prefill-ai、錯題頁的批次詳解）時每個請求包含的題數，1 表示逐題生成",
+    )
+    parser.add_argument(
+        "--ai-batch-workers",
+        default=2,
+        type=int,
+        help="錯題頁批次詳解同時進行的批次請求數",
+    )
+    parser.add_argument(
+        "--ai-rpm", default=None, type=int, help="Gemini 每分鐘請求數上限（預設不限制）"
+    )
+    parser.add_argument(
+        "--ai-tpm", default=None, type=int, help="Gemini 每分鐘 token 數上限（預設不限制）"
+    )
+    parser.add_argument(
+        "--ai-max-wait",
+        default=30.0,
+        type=float,
+        help="AI 詳解請求排隊等待的秒數上限，超過時回傳錯誤",
+    )
+    parser.add_argument(
+        "--prefetch-ai",
+        action="store_true",
+        help="依序與錯題模式出題時，在背景預先生成下一題的 AI 詳解",
+    )
+    parser.add_argument(
+        "--prefetch-concurrency", default=2, type=int, help="同時進行的預先生成數量上限"
+    )
+    parser.add_argument(
+        "--prefetch-token-budget",
+        default=None,
+        type=int,
+        help="預先生成可使用的 token 上限（預設不限制）",
+    )
+    parser.add_argument(
+        "--workers",
+        default=1,
+        type=int,
+        help="平行解析題庫的行程數（預設 1，不平行）",
+    )
     args = parser.parse_args()
 
-    # BUG: load ok but bug in some cases (index problem)
+    explanation_cache = ExplanationCache(
+        args.ai_cache,
+        max_entries=args.ai_cache_max,
+        max_age_days=args.ai_cache_days,
+        memory_entries=args.ai_cache_memory,
+    )
+    if args.async_ai:
+        ai_runner = AsyncGeminiRunner()
+    ai_flights.cancel_when_unobserved = args.ai_disconnect == "cancel"
+    rate_limiter = RateLimiter(
+        rpm=args.ai_rpm, tpm=args.ai_tpm, max_wait=args.ai_max_wait
+    )
+    ai_batch_size = args.ai_batch_size
+    batch_executor = ThreadPoolExecutor(max_workers=args.ai_batch_workers)
+    if args.prefetch_ai:
+        if ai_key:
+            prefetcher = Prefetcher(
+                start_explanation,
+                max_inflight=args.prefetch_concurrency,
+                token_budget=args.prefetch_token_budget,
+            )
+        else:
+            print("⚠️ 未設定 API Key，不啟用預先生成")
+    try:
+        answer_journal = AnswerJournal(args.history)
+    except OSError as e:
+        parser.error(f"無法開啟作答紀錄檔案 {args.history}：{e}")
+
     if args.save:
         try:
             with open(args.save, "r", encoding="utf-8") as f:
                 data = json.load(f)
+            if data.get("version") == PROGRESS_VERSION:
+                # 精簡格式：重新載入進度中記錄的題庫，再套用題號清單與 bitset
+                load_questions([bank["path"] for bank in data["banks"]])
+                restore_progress(default_state, data)
+                print(
+                    f"✅ 進度檔案已載入，總題數：{len(questions)}，已答題數：{default_state.answered_count}"
+                )
+            else:
+                # 舊格式：題目內容直接存在進度檔案中
                 questions = data.get("questions", [])
-                answered_questions = set(data.get("answered_questions", []))
-                wrong_questions = data.get("wrong_questions", [])
-                marked_questions = data.get("marked_questions", [])
                 question_index_dict = {q["題號"]: i for i, q in enumerate(questions)}
-                wrong_questions_answer_count = data.get(
+                question_images = {
+                    k: Path(v) for k, v in data.get("question_images", {}).items()
+                }
+                build_search_index()
+                reset_quiz_state()
+                for question_id in data.get("answered_questions", []):
+                    if question_id in question_index_dict:
+                        default_state.mark_answered(question_index_dict[question_id])
+                default_state.set_wrong(
+                    remember_questions(data.get("wrong_questions", []))
+                )
+                default_state.marked = dict.fromkeys(
+                    remember_questions(data.get("marked_questions", []))
+                )
+                default_state.wrong_answer_count = data.get(
                     "wrong_questions_answer_count", 0
                 )
-                remaining_questions = data.get("remaining_questions", list(questions))
-                question_index = data.get("question_index", 0)
+                saved_order = data.get("random_order")
+                if saved_order is not None and len(saved_order) == len(questions):
+                    default_state.random_order = array("I", saved_order)
+                    default_state.random_cursor = data.get("random_cursor", 0)
+                default_state.question_index = data.get("question_index", 0)
                 print(
-                    f"✅ 進度檔案已載入，總題數：{len(questions)}，已答題數：{len(answered_questions)}"
+                    f"✅ 進度檔案已載入，總題數：{len(questions)}，已答題數：{default_state.answered_count}"
                 )
         except Exception as e:
             print(f"❌ 載入進度檔案失敗：{e}")
@@ -711,14 +1533,13 @@ if __name__ == "__main__":
     if args.wrong:
 
         def load_wrong_questions(json_path):
-            global wrong_questions
             try:
                 with open(json_path, "r", encoding="utf-8") as f:
                     data = json.load(f)
                     if isinstance(data, list):
-                        wrong_questions = data
+                        default_state.set_wrong(remember_questions(data))
                         print(
-                            f"✅ 載入錯題檔案：{json_path}，題數：{len(wrong_questions)}"
+                            f"✅ 載入錯題檔案：{json_path}，題數：{len(default_state.wrong)}"
                         )
                     else:
                         print(f"⚠️ {json_path} 格式錯誤，非陣列，略過")
@@ -726,7 +1547,20 @@ if __name__ == "__main__":
                 print(f"❌ 處理錯題檔案 {json_path} 時發生錯誤：{e}")
 
         load_wrong_questions(args.wrong)
-        print(f"✅ 錯題檔案已載入，總題數：{len(wrong_questions)}")
+        print(f"✅ 錯題檔案已載入，總題數：{len(default_state.wrong)}")
+
+    if args.prefill_ai:
+        if not ai_key:
+            print("❌ 未設定 API Key，無法預先生成 AI 詳解")
+        else:
+            prefill_ai_explanations(
+                workers=args.prefill_workers,
+                rpm=args.prefill_rpm,
+                token_budget=args.prefill_token_budget,
+                is_detail=args.prefill_detail,
+                batch_size=args.ai_batch_size,
+            )
+        raise SystemExit
 
     print(f"🌏 網頁出題機：http://{args.host}:{args.port}")
     app.run(host=args.host, port=args.port, debug=True, use_reloader=False)
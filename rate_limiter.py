@@ -0,0 +1,277 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+# Gemini 呼叫的限流：以 token bucket 限制每分鐘請求數 (RPM) 與 token 數 (TPM)。
+# 等待中的呼叫依使用者輪流取得額度，避免單一使用者的大量請求佔滿配額；
+# 上游回應配額錯誤 (429) 時以隨機退避重試，並暫停所有呼叫一段時間。
+
+_END = object()
+
+
+class RateLimitTimeout(Exception):
+    """排隊等待超過上限仍無法取得額度。"""
+
+
+def is_quota_error(error):
+    code = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if code == 429:
+        return True
+    text = str(error)
+    return "429" in text or "RESOURCE_EXHAUSTED" in text
+
+
+class _Bucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        # 單次需求超過容量時，等到額度全滿即可放行
+        need = min(amount, self.capacity) - self.level
+        return 0 if need <= 0 else need / self.rate
+
+
+class RateLimiter:
+    """RPM / TPM 限流器，附使用者間公平排隊、等待上限與配額錯誤重試。
+
+    rpm、tpm 為 None 表示不限制。呼叫前先以估計的 token 數 (estimated_tokens) 預留額度，
+    取得實際用量後再以 settle 校正。
+    """
+
+    def __init__(
+        self,
+        rpm=None,
+        tpm=None,
+        max_wait=30.0,
+        estimated_tokens=1000,
+        retries=3,
+        backoff=1.0,
+        max_backoff=30.0,
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_wait = max_wait
+        self.estimated_tokens = estimated_tokens
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._requests = _Bucket(rpm) if rpm else None
+        self._tokens = _Bucket(tpm) if tpm else None
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+        self._queues = {}  # 使用者 -> 等待中的呼叫
+        self._turns = deque()  # 輪流取得額度的使用者順序
+        self.granted = 0
+        self.timeouts = 0
+        self.retried = 0
+        self.quota_errors = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+
+    def acquire(self, user="", tokens=None):
+        """排隊取得一次呼叫的額度，回傳預留的 token 數。
+
+        等待超過 max_wait 秒時拋出 RateLimitTimeout。
+        """
+        tokens = self.estimated_tokens if tokens is None else tokens
+        ticket = object()
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        with self._cond:
+            queue = self._queues.get(user)
+            if queue is None:
+                queue = self._queues[user] = deque()
+                self._turns.append(user)
+            queue.append(ticket)
+            granted = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._turns[0] == user and queue[0] is ticket:
+                        wait = self._wait_time(now, tokens)
+                        if wait <= 0:
+                            break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise RateLimitTimeout(
+                            f"AI 請求排隊超過 {self.max_wait:g} 秒，請稍後再試"
+                        )
+                    self._cond.wait(remaining if wait is None else min(wait, remaining))
+                if self._requests is not None:
+                    self._requests.level -= 1
+                if self._tokens is not None:
+                    self._tokens.level -= tokens
+                granted = True
+                waited = time.monotonic() - start
+                self.granted += 1
+                self._total_wait += waited
+                self._max_wait_seen = max(self._max_wait_seen, waited)
+            finally:
+                queue.remove(ticket)
+                if granted:
+                    # 輪到下一位使用者；仍有等待中的呼叫時排到最後
+                    self._turns.popleft()
+                    if queue:
+                        self._turns.append(user)
+                elif not queue:
+                    self._turns.remove(user)
+                if not queue:
+                    del self._queues[user]
+                self._cond.notify_all()
+        return tokens
+
+    def settle(self, reserved, used):
+        """以實際使用的 token 數校正預留的額度。"""
+        with self._cond:
+            if self._tokens is not None:
+                self._tokens.level = min(
+                    self._tokens.capacity, self._tokens.level + reserved - used
+                )
+            self._cond.notify_all()
+
+    def call(self, request, user=""):
+        """限流執行單次呼叫 request()，回傳其結果（需有 usage_metadata）。"""
+        attempt = 0
+        while True:
+            reserved = self.acquire(user)
+            try:
+                response = request()
+            except Exception as e:
+                self.settle(reserved, 0)
+                if not self._should_retry(e, attempt):
+                    raise
+                time.sleep(self._quota_backoff(attempt))
+                attempt += 1
+                continue
+            usage = getattr(response, "usage_metadata", None)
+            self.settle(reserved, (usage.total_token_count or 0) if usage else reserved)
+            return response
+
+    def stream(self, open_stream, user=""):
+        """限流讀取串流：open_stream() 回傳片段的 iterable。
+
+        收到第一個片段前遇到配額錯誤會退避後重新排隊；結束（或中途關閉）時以片段中的 usage 校正額度。
+        """
+        attempt = 0
+        while True:
+            reserved = self.acquire(user)
+            try:
+                iterator = iter(open_stream())
+                first = next(iterator, _END)
+            except Exception as e:
+                self.settle(reserved, 0)
+                if not self._should_retry(e, attempt):
+                    raise
+                time.sleep(self._quota_backoff(attempt))
+                attempt += 1
+                continue
+            break
+
+        used = 0
+        try:
+            chunk = first
+            while chunk is not _END:
+                used = _usage_tokens(chunk, used)
+                yield chunk
+                chunk = next(iterator, _END)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+            self.settle(reserved, used)
+
+    async def astream(self, open_stream, user=""):
+        """stream 的非同步版本：open_stream() 回傳 coroutine，其結果為非同步串流。"""
+        attempt = 0
+        while True:
+            # 排隊會阻塞，交給執行緒等待，不佔用 event loop
+            reserved = await asyncio.to_thread(self.acquire, user)
+            try:
+                iterator = (await open_stream()).__aiter__()
+                first = await anext(iterator, _END)
+            except Exception as e:
+                self.settle(reserved, 0)
+                if not self._should_retry(e, attempt):
+                    raise
+                await asyncio.sleep(self._quota_backoff(attempt))
+                attempt += 1
+                continue
+            break
+
+        used = 0
+        try:
+            chunk = first
+            while chunk is not _END:
+                used = _usage_tokens(chunk, used)
+                yield chunk
+                chunk = await anext(iterator, _END)
+        finally:
+            self.settle(reserved, used)
+
+    def metrics(self):
+        with self._cond:
+            now = time.monotonic()
+            for bucket in (self._requests, self._tokens):
+                if bucket is not None:
+                    bucket.refill(now)
+            return {
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "queue_depth": sum(len(queue) for queue in self._queues.values()),
+                "waiting_users": len(self._queues),
+                "granted": self.granted,
+                "timeouts": self.timeouts,
+                "retries": self.retried,
+                "quota_errors": self.quota_errors,
+                "avg_wait_seconds": self._total_wait / self.granted if self.granted else 0.0,
+                "max_wait_seconds": self._max_wait_seen,
+                "requests_available": self._requests.level if self._requests else None,
+                "tokens_available": self._tokens.level if self._tokens else None,
+                "paused_seconds": max(0.0, self._paused_until - now),
+            }
+
+    def _wait_time(self, now, tokens):
+        """距離可放行還需等待的秒數；呼叫端需持有鎖。"""
+        wait = max(0.0, self._paused_until - now)
+        if self._requests is not None:
+            self._requests.refill(now)
+            wait = max(wait, self._requests.wait_time(1))
+        if self._tokens is not None:
+            self._tokens.refill(now)
+            wait = max(wait, self._tokens.wait_time(tokens))
+        return wait
+
+    def _should_retry(self, error, attempt):
+        if not is_quota_error(error):
+            return False
+        with self._cond:
+            self.quota_errors += 1
+        return attempt < self.retries
+
+    def _quota_backoff(self, attempt):
+        """配額錯誤後的等待秒數（指數退避加隨機抖動），並暫停所有呼叫同樣的時間。"""
+        delay = min(self.max_backoff, self.backoff * 2**attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        with self._cond:
+            self.retried += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            self._cond.notify_all()
+        return delay
+
+
+def _usage_tokens(chunk, default):
+    usage = getattr(chunk, "usage_metadata", None)
+    if usage and usage.total_token_count:
+        return usage.total_token_count
+    return default
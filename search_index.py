@@ -0,0 +1,136 @@
+import base64
+import bisect
+import sys
+from array import array
+
+# 題目搜尋用的倒排索引：字元 bigram / trigram -> 含有該片段的題目索引（遞增排序）。
+# 為了讓數百個題庫的索引也只佔少量記憶體，所有片段串成一個字串、所有題目索引放在同一個
+# array('I')，不為每個片段建立 Python 物件。每個題庫各自建立索引並隨編譯快取保存。
+# 單一字元的關鍵字沒有可用的片段，由呼叫端逐題掃描。
+
+_SEPARATOR = "\x00"
+
+
+def search_text(q):
+    """組合題號、題目、選項與答案，作為搜尋比對的文字。"""
+    return (
+        q.get("題號", "")
+        + " "
+        + q.get("題目", "")
+        + " "
+        + " ".join(q.get("選項", []))
+        + " 答案:"
+        + q.get("答案", "")
+    )
+
+
+def keyword_grams(keyword):
+    """關鍵字對應的片段：兩個字元用 bigram，三個字元以上用 trigram；單一字元回傳空集合。"""
+    lowered = keyword.lower()
+    n = 2 if len(lowered) == 2 else 3
+    return {lowered[j : j + n] for j in range(len(lowered) - n + 1)}
+
+
+def _pack(values):
+    values = array("I", values)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode("ascii")
+
+
+def _unpack(encoded):
+    values = array("I")
+    values.frombytes(base64.b64decode(encoded))
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+class _Grams:
+    """以序列介面讀取串接字串中的第 i 個片段，供 bisect 搜尋。"""
+
+    __slots__ = ("text", "starts")
+
+    def __init__(self, text, starts):
+        self.text = text
+        self.starts = starts
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    def __getitem__(self, i):
+        # 每個片段後面接一個分隔字元
+        return self.text[self.starts[i] : self.starts[i + 1] - 1]
+
+
+class SearchIndex:
+    """單一題庫的唯讀倒排索引。"""
+
+    __slots__ = ("_grams", "_offsets", "_postings")
+
+    def __init__(self, grams, offsets, postings):
+        self._grams = grams
+        self._offsets = offsets
+        self._postings = postings
+
+    @classmethod
+    def build(cls, texts):
+        """由每題的搜尋文字建立索引。"""
+        postings = {}
+        for i, text in enumerate(texts):
+            lowered = text.lower()
+            grams = {lowered[j : j + 2] for j in range(len(lowered) - 1)}
+            grams.update(lowered[j : j + 3] for j in range(len(lowered) - 2))
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        gram_starts = array("I", [0])
+        offsets = array("I", [0])
+        flat = array("I")
+        ordered = sorted(postings)
+        for gram in ordered:
+            gram_starts.append(gram_starts[-1] + len(gram) + 1)
+            flat.extend(postings[gram])
+            offsets.append(len(flat))
+        text = "".join(gram + _SEPARATOR for gram in ordered)
+        return cls(_Grams(text, gram_starts), offsets, flat)
+
+    def to_data(self):
+        """轉成可寫入 JSON 快取的純資料。"""
+        return {
+            "grams": self._grams.text,
+            "gram_starts": _pack(self._grams.starts),
+            "offsets": _pack(self._offsets),
+            "postings": _pack(self._postings),
+        }
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(
+            _Grams(data["grams"], _unpack(data["gram_starts"])),
+            _unpack(data["offsets"]),
+            _unpack(data["postings"]),
+        )
+
+    def posting(self, gram):
+        """含有 gram 的題目索引（遞增排序的 memoryview），沒有時回傳空序列。"""
+        i = bisect.bisect_left(self._grams, gram)
+        if i >= len(self._grams) or self._grams[i] != gram:
+            return ()
+        return memoryview(self._postings)[self._offsets[i] : self._offsets[i + 1]]
+
+    def candidates(self, grams):
+        """同時含有所有 grams 的題目索引（遞增排序）。"""
+        postings = sorted((self.posting(gram) for gram in grams), key=len)
+        if not postings or not postings[0]:
+            return []
+        smallest, others = postings[0], postings[1:]
+        return [
+            i
+            for i in smallest
+            if all(_contains(posting, i) for posting in others)
+        ]
+
+
+def _contains(posting, value):
+    i = bisect.bisect_left(posting, value)
+    return i < len(posting) and posting[i] == value
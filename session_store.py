@@ -0,0 +1,157 @@
+import pickle
+import secrets
+import sqlite3
+import threading
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# 伺服器端 session：資料以 pickle 存在 SQLite，cookie 只保存隨機的 session id。
+# 每個請求只需讀寫一列資料，cookie 大小固定，不受錯題數量或詳解長度影響。
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class SqliteSessionInterface(SessionInterface):
+    """以 SQLite 保存 session 內容的 Flask session interface。
+
+    session 超過 app.permanent_session_lifetime 未寫入即視為過期，
+    每寫入 purge_every 次清除一次過期資料。
+    """
+
+    def __init__(self, path, purge_every=1000):
+        self.path = str(path)
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                expires_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)"
+        )
+        with self._lock:
+            self._purge()
+            self._conn.commit()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT data FROM sessions WHERE sid = ? AND expires_at > ?",
+                    (sid, time.time()),
+                ).fetchone()
+            if row is not None:
+                try:
+                    return ServerSession(pickle.loads(row[0]), sid=sid)
+                except Exception:
+                    pass
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            # session 被清空時一併刪除伺服器端資料與 cookie
+            if session.modified and not session.new:
+                self.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified:
+            self.write(app, session)
+
+        if session.new or (session.modified and session.permanent):
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+    def write(self, app, session):
+        """立即保存整個 session。"""
+        expires_at = time.time() + app.permanent_session_lifetime.total_seconds()
+        data = pickle.dumps(dict(session), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (sid, data, expires_at)"
+                " VALUES (?, ?, ?)",
+                (session.sid, data, expires_at),
+            )
+            self._writes += 1
+            if self._writes % self.purge_every == 0:
+                self._purge()
+            self._conn.commit()
+        session.modified = False
+
+    def update(self, app, sid, modify):
+        """讀出最新的 session 內容，以 modify(data) 修改後寫回。
+
+        回應送出後才需要更新的串流使用此方法：其間同一使用者的其他請求可能已更新 session，
+        直接寫回請求開始時的內容會覆蓋掉那些變更。
+        """
+        expires_at = time.time() + app.permanent_session_lifetime.total_seconds()
+        with self._lock:
+            # BEGIN IMMEDIATE 讓多個 worker 行程的讀取與寫回不會交錯
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT data FROM sessions WHERE sid = ?", (sid,)
+                ).fetchone()
+                data = pickle.loads(row[0]) if row is not None else {}
+                modify(data)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sessions (sid, data, expires_at)"
+                    " VALUES (?, ?, ?)",
+                    (sid, pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL), expires_at),
+                )
+            except BaseException:
+                self._conn.rollback()
+                raise
+            self._conn.commit()
+        return data
+
+    def regenerate(self, session):
+        """換發新的 session id，並刪除舊 id 的伺服器端資料；內容保留，回應時寫入新的 cookie。
+
+        登入成功時呼叫，讓登入前（可能被他人預先指定）的 session id 無法存取登入後的資料。
+        """
+        if not session.new:
+            self.delete(session.sid)
+        session.sid = secrets.token_urlsafe(32)
+        session.new = True
+        session.modified = True
+
+    def delete(self, sid):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+            self._conn.commit()
+
+    def _purge(self):
+        """刪除過期的 session；呼叫端需持有鎖。"""
+        self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
@@ -0,0 +1,184 @@
+import secrets
+import threading
+
+# 相同 (題號, prompt) 的 AI 詳解請求只呼叫一次 Gemini：
+# 第一個請求在背景執行緒開始生成，之後的請求附加到同一個生成過程，
+# 先重播已產生的片段，再接著讀取後續內容。
+# cancel_when_unobserved 為 True 時，最後一個讀取端離開（例如瀏覽器關閉連線）就要求停止生成；
+# 否則生成會在背景繼續完成並寫入快取。
+
+
+class Flight:
+    """一次進行中的生成；可被多個請求同時讀取。"""
+
+    def __init__(self, cancel_when_unobserved=False):
+        # 每次生成各自的識別碼，讓斷線重連的讀取端確認接續的是同一個生成
+        self.id = secrets.token_hex(4)
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.tokens = 0
+        self.cancelled = False
+        self.cancel_when_unobserved = cancel_when_unobserved
+        self._subscribers = 0
+        self._on_cancel = []
+        self._cond = threading.Condition()
+
+    @property
+    def text(self):
+        with self._cond:
+            return "".join(self.chunks)
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, tokens=0):
+        with self._cond:
+            self.tokens = tokens
+            self.done = True
+            self._cond.notify_all()
+
+    def fail(self, error, tokens=0):
+        with self._cond:
+            self.error = error
+            self.tokens = tokens
+            self.done = True
+            self._cond.notify_all()
+
+    def cancel(self):
+        """要求停止生成：生產端需檢查 cancelled，或由 on_cancel 中斷上游請求。"""
+        with self._cond:
+            if self.done or self.cancelled:
+                return
+            self.cancelled = True
+            callbacks = list(self._on_cancel)
+        for callback in callbacks:
+            callback()
+
+    def on_cancel(self, callback):
+        """加入取消時呼叫的函式；若已被取消則立即呼叫。"""
+        with self._cond:
+            self._on_cancel.append(callback)
+            cancelled = self.cancelled and not self.done
+        if cancelled:
+            callback()
+
+    def follow(self, start=0):
+        """依序產生第 start 個之後的片段，直到生成結束；結束後請檢查 error。"""
+        index = start
+        self._enter()
+        try:
+            while True:
+                with self._cond:
+                    while index >= len(self.chunks) and not self.done:
+                        self._cond.wait()
+                    new_chunks = self.chunks[index:]
+                    done = self.done
+                yield from new_chunks
+                index += len(new_chunks)
+                if done and index >= len(self.chunks):
+                    return
+        finally:
+            self._leave()
+
+    def wait_started(self):
+        """等待第一個片段產生或生成結束；不算讀取端，不影響 cancel_when_unobserved。"""
+        with self._cond:
+            while not self.chunks and not self.done:
+                self._cond.wait()
+
+    def wait(self):
+        """等待生成結束並回傳完整文字；結束後請檢查 error。"""
+        self._enter()
+        try:
+            with self._cond:
+                while not self.done:
+                    self._cond.wait()
+            return self.text
+        finally:
+            self._leave()
+
+    def _enter(self):
+        with self._cond:
+            self._subscribers += 1
+
+    def _leave(self):
+        with self._cond:
+            self._subscribers -= 1
+            unobserved = (
+                self.cancel_when_unobserved
+                and self._subscribers == 0
+                and not self.done
+            )
+        if unobserved:
+            self.cancel()
+
+
+class FlightGroup:
+    """以鍵值合併同時進行的生成。"""
+
+    def __init__(self, cancel_when_unobserved=False):
+        self.cancel_when_unobserved = cancel_when_unobserved
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def run(self, key, produce, runner=None):
+        """若 key 沒有進行中的生成，在背景執行 produce(flight)。
+
+        回傳 (flight, started)；started 為 True 表示本次呼叫啟動了新的生成。
+        produce 需自行呼叫 flight.finish()；拋出例外時會轉為 flight.fail()。
+        指定 runner (AsyncGeminiRunner) 時，produce(flight) 需回傳 coroutine，
+        並在 runner 的 event loop 上執行，而不另開執行緒；取消時會一併取消該 coroutine。
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            # 已被取消的生成只是在等生產端結束，不再讓新的請求附加
+            if flight is not None and not flight.cancelled:
+                return flight, False
+            flight = Flight(self.cancel_when_unobserved)
+            self._flights[key] = flight
+        # 取消時立即移出群組，之後相同鍵值的請求會開始新的生成
+        flight.on_cancel(lambda: self._forget(key, flight))
+
+        if runner is not None:
+
+            async def target_async():
+                try:
+                    await produce(flight)
+                except Exception as e:
+                    flight.fail(e)
+                finally:
+                    self._done(key, flight)
+
+            future = runner.submit(target_async())
+            flight.on_cancel(future.cancel)
+            # coroutine 尚未開始就被取消時不會執行 finally，需在此結束 flight
+            future.add_done_callback(lambda _: self._done(key, flight))
+            return flight, True
+
+        def target():
+            try:
+                produce(flight)
+            except Exception as e:
+                flight.fail(e)
+            finally:
+                self._done(key, flight)
+
+        threading.Thread(target=target, daemon=True).start()
+        return flight, True
+
+    def _done(self, key, flight):
+        if not flight.done:
+            flight.fail(RuntimeError("生成未正常結束"))
+        self._forget(key, flight)
+
+    def _forget(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._flights)